@@ -0,0 +1,326 @@
+# benchmark.py
+# NLDS lab
+# Times stringMatchTool.py, regexMatchTool.py and twitterMatchTool.py
+# against a synthetic corpus, so changes to them can be compared
+#   builds a sqlite database with posts, texts and tweets tables
+#       made up of words from LIWC_lexicons plus some filler,
+#       with a given size, reply depth and share of duplicate texts
+#   runs each tool's whole main() on it in its own process
+#   prints posts/sec, time per pipeline stage and peak memory as json
+#   with --batch-sizes, also the peak memory of a run at each batch size,
+#       which should stay about flat (only chunks of rows are in flight)
+# The corpus only depends on the options and --seed, so two runs with
+# the same options on different commits see exactly the same data.
+# Needs sqlalchemy, like the tools themselves (but not oursql/MySQL).
+#
+# e.g.  python benchmark.py --posts 20000 --out before.json
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+###########
+# Globals #
+###########
+
+here = os.path.dirname(os.path.abspath(__file__))
+lexicon_dir = os.path.join(here, 'LIWC_lexicons')
+
+# dataset ids in the generated database
+# (twitterMatchTool.py looks at dataset 7 unless given --dataset)
+posts_dataset_id = 1
+tweets_dataset_id = 7
+
+tools = {
+    'string':   'stringMatchTool.py',
+    'regex':    'regexMatchTool.py',
+    'twitter':  'twitterMatchTool.py',
+}
+
+# common words to pad texts out between lexicon words,
+# including the ones the A/B patterns look for at the start of a post
+filler = '''i you he she it we they the a an and but or so of to in on at
+for with about that this is was are be have has had do did not no yes
+really wow well oh guess think know like just what why how interesting
+cool okay right sure maybe very much some any more most there here then
+'''.split()
+
+# endings tacked onto word* lexicon entries
+suffixes = ['', '', 's', 'ed', 'ing', 'er']
+
+#################
+# Corpus making #
+#################
+
+# every lexicon entry as a usable word, wildcards with a random ending
+def loadVocabulary(rng):
+    words = []
+    for name in sorted(os.listdir(lexicon_dir)):
+        with open(os.path.join(lexicon_dir, name)) as f:
+            for line in f:
+                word = line.strip()
+                if not word or not word.replace('*','').replace("'",'').isalpha():
+                    continue
+                if word.endswith('*'):
+                    word = word[:-1]+rng.choice(suffixes)
+                words.append(word)
+    return words
+
+# one text of about n words: sentences of 3-20 words,
+# ending in . ? or !, now and then on a new line
+def makeText(rng, vocabulary, n):
+    sentences = []
+    left = n
+    while left > 0:
+        size = min(left, rng.randint(3, 20))
+        words = []
+        for i in range(size):
+            if rng.random() < 0.3:
+                words.append(rng.choice(vocabulary))
+            else:
+                words.append(rng.choice(filler))
+        sentence = ' '.join(words)
+        sentences.append(sentence[0].upper()+sentence[1:]+rng.choice('..?!'))
+        left -= size
+    text = sentences[0]
+    for sentence in sentences[1:]:
+        text += rng.choice(['\n', ' ', ' ', ' '])+sentence
+    return text
+
+# word counts spread out like real posts: mostly a few dozen words,
+# some too short or too long for the 10-150 word filter
+def textLength(rng):
+    return max(1, int(rng.lognormvariate(3.5, 0.8)))
+
+# texts for count posts/tweets, a dup_rate share of them copies of earlier ones
+def makeTexts(rng, vocabulary, count, dup_rate):
+    texts = []
+    for i in range(count):
+        if texts and rng.random() < dup_rate:
+            texts.append(rng.choice(texts))
+        else:
+            texts.append(makeText(rng, vocabulary, textLength(rng)))
+    return texts
+
+# for each item, the index of an earlier one it replies to, or None
+# replies only go reply_depth levels deep, items are grouped in threads
+# of thread_size so replies stay within a discussion
+def makeReplies(rng, count, thread_size, reply_depth, reply_rate=0.7):
+    parents = []
+    depths = []
+    for i in range(count):
+        start = i-i%thread_size
+        candidates = [j for j in range(start, i) if depths[j] < reply_depth]
+        if candidates and rng.random() < reply_rate:
+            parent = rng.choice(candidates)
+            parents.append(parent)
+            depths.append(depths[parent]+1)
+        else:
+            parents.append(None)
+            depths.append(0)
+    return parents
+
+# write the whole corpus to a new sqlite database at path
+def makeDatabase(path, posts, tweets, thread_size, reply_depth, dup_rate, seed):
+    rng = random.Random(seed)
+    vocabulary = loadVocabulary(rng)
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        create table texts (
+            dataset_id integer, text_id integer, text text,
+            primary key (dataset_id, text_id));
+        create table posts (
+            dataset_id integer, discussion_id integer, post_id integer,
+            author_id integer, parent_post_id integer, text_id integer,
+            primary key (dataset_id, discussion_id, post_id));
+        create table tweets (
+            dataset_id integer, tweet_id integer, text_id integer,
+            in_reply_to_tweet_id integer,
+            primary key (dataset_id, tweet_id));
+    ''')
+
+    texts = makeTexts(rng, vocabulary, posts, dup_rate)
+    parents = makeReplies(rng, posts, thread_size, reply_depth)
+    conn.executemany('insert into texts values (?,?,?)',
+        [(posts_dataset_id, i+1, text) for i, text in enumerate(texts)])
+    rows = []
+    for i, parent in enumerate(parents):
+        disc_id = i//thread_size+1
+        post_id = i%thread_size+1
+        parent_post_id = None if parent is None else parent%thread_size+1
+        rows.append((posts_dataset_id, disc_id, post_id, rng.randint(1, 1000),
+            parent_post_id, i+1))
+    conn.executemany('insert into posts values (?,?,?,?,?,?)', rows)
+
+    texts = makeTexts(rng, vocabulary, tweets, dup_rate)
+    parents = makeReplies(rng, tweets, thread_size, reply_depth)
+    tweet_ids = []
+    tweet_id = 10**17
+    for i in range(tweets):
+        tweet_id += rng.randint(1, 10**6)
+        tweet_ids.append(tweet_id)
+    conn.executemany('insert into texts values (?,?,?)',
+        [(tweets_dataset_id, i+1, text) for i, text in enumerate(texts)])
+    conn.executemany('insert into tweets values (?,?,?,?)',
+        [(tweets_dataset_id, tweet_ids[i], i+1,
+            None if parent is None else tweet_ids[parent])
+            for i, parent in enumerate(parents)])
+    conn.commit()
+    conn.close()
+
+###########
+# Running #
+###########
+
+# run one tool on the database in its own directory, returns its --stats
+# plus the wall clock time, which includes starting python and connecting
+def runTool(name, db_path, workdir, extra_args):
+    os.makedirs(workdir)
+    # the regex tools read their lexicons from ./LIWC_lexicons
+    os.symlink(lexicon_dir, os.path.join(workdir, 'LIWC_lexicons'))
+    stats_file = os.path.join(workdir, 'stats.json')
+    cmd = [sys.executable, os.path.join(here, tools[name]),
+            'bench', 'bench', 'sqlite:///'+db_path]
+    if name != 'twitter':
+        cmd.append(str(posts_dataset_id))
+    cmd += ['--stats', stats_file]+extra_args
+    log_file = os.path.join(workdir, 'output.log')
+    start = time.perf_counter()
+    with open(log_file, 'w') as log:
+        result = subprocess.run(cmd, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    wall = time.perf_counter()-start
+    if result.returncode != 0:
+        with open(log_file) as log:
+            sys.stderr.write(log.read()[-2000:])
+        raise RuntimeError(name+' tool exited with '+str(result.returncode))
+    with open(stats_file) as f:
+        stats = json.load(f)
+    stats['wall_seconds'] = wall
+    return stats
+
+# the commit being measured, so results files say what they are for
+def currentCommit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=here,
+                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return out.stdout.decode().strip() or None
+    except OSError:
+        return None
+
+# the fastest of repeat runs of each tool
+def runBenchmark(args, tmpdir):
+    db_path = os.path.join(tmpdir, 'bench.db')
+    print('Building corpus in',db_path, file=sys.stderr)
+    makeDatabase(db_path, args.posts, args.tweets, args.thread_size,
+        args.reply_depth, args.dup_rate, args.seed)
+    extra_args = ['--workers', str(args.workers)]
+    if args.compress:
+        extra_args += ['--compress', args.compress]
+    results = {
+        'commit': currentCommit(),
+        'python': sys.version.split()[0],
+        'corpus': {
+            'posts': args.posts, 'tweets': args.tweets,
+            'thread_size': args.thread_size, 'reply_depth': args.reply_depth,
+            'dup_rate': args.dup_rate, 'seed': args.seed,
+        },
+        'workers': args.workers,
+        'tools': {},
+    }
+    for name in args.tools:
+        count = args.tweets if name == 'twitter' else args.posts
+        runs = []
+        for i in range(args.repeat):
+            print('Running',tools[name],'run',i+1,'of',args.repeat, file=sys.stderr)
+            workdir = os.path.join(tmpdir, '{}-{}'.format(name, i+1))
+            runs.append(runTool(name, db_path, workdir, extra_args))
+        best = min(runs, key=lambda run: run['seconds'])
+        results['tools'][name] = {
+            'posts': count,
+            'posts_per_sec': count/best['seconds'],
+            'seconds': best['seconds'],
+            'wall_seconds': best['wall_seconds'],
+            'all_seconds': [run['seconds'] for run in runs],
+            'rows': best['rows'],
+            'stages': best['stages'],
+            'peak_rss_kb': best['peak_rss_kb'],
+            'workers_peak_rss_kb': best['workers_peak_rss_kb'],
+        }
+        # batch_size only decides how often a checkpoint is written
+        if args.batch_sizes:
+            by_size = {}
+            for size in args.batch_sizes:
+                print('Running',tools[name],'with --batch-size',size, file=sys.stderr)
+                workdir = os.path.join(tmpdir, '{}-batch-{}'.format(name, size))
+                run = runTool(name, db_path, workdir,
+                        extra_args+['--batch-size', str(size)])
+                by_size[str(size)] = {
+                    'seconds': run['seconds'],
+                    'peak_rss_kb': run['peak_rss_kb'],
+                }
+            results['tools'][name]['batch_sizes'] = by_size
+    return results
+
+##################
+# Main Execution #
+##################
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Time the match tools on a synthetic sqlite corpus.')
+    parser.add_argument('--posts', type=int, default=5000,
+        help='posts to generate (default %(default)s)')
+    parser.add_argument('--tweets', type=int, default=5000,
+        help='tweets to generate (default %(default)s)')
+    parser.add_argument('--thread-size', type=int, default=20,
+        help='posts per discussion (default %(default)s)')
+    parser.add_argument('--reply-depth', type=int, default=3,
+        help='how deep reply chains go, 0 for no replies (default %(default)s)')
+    parser.add_argument('--dup-rate', type=float, default=0.05,
+        help='share of texts that copy an earlier one (default %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+        help='random seed for the corpus (default %(default)s)')
+    parser.add_argument('--tools', nargs='+', choices=sorted(tools),
+        default=['string', 'regex', 'twitter'], help='which tools to run')
+    parser.add_argument('--repeat', type=int, default=1,
+        help='runs per tool, the fastest is reported (default %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+        help='passed on to the tools (default %(default)s)')
+    parser.add_argument('--compress', choices=['gz', 'bz2', 'xz'],
+        help='passed on to the tools')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', metavar='N',
+        help='also run each tool once with each --batch-size N '
+            'and report its peak memory')
+    parser.add_argument('--out', metavar='FILE',
+        help='also write the results to FILE')
+    parser.add_argument('--keep', metavar='DIR',
+        help='build the corpus and run the tools in DIR and leave it there')
+    return parser.parse_args(argv)
+
+def main(args=None):
+    if args is None:
+        args = parseArgs()
+    if args.keep:
+        os.makedirs(args.keep)
+        results = runBenchmark(args, os.path.abspath(args.keep))
+    else:
+        tmpdir = tempfile.mkdtemp(prefix='matchbench_')
+        try:
+            results = runBenchmark(args, tmpdir)
+        finally:
+            shutil.rmtree(tmpdir)
+    report = json.dumps(results, indent=2)
+    print(report)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(report+'\n')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1790 @@
+# matchUtils.py
+# NLDS lab
+# Helpers shared by stringMatchTool.py, regexMatchTool.py and twitterMatchTool.py
+# Nothing in here touches the database, so it can be used (and tried out)
+# without sqlalchemy/oursql installed.
+
+import array
+import bz2
+import collections
+import concurrent.futures
+import csv
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import lzma
+import mmap
+import multiprocessing
+import os
+import pickle
+import queue
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+# only for --stats memory figures, not there on Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# only for --counts, which saves scipy sparse matrices
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = sparse = None
+
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
+##########################
+# Multi-pattern matching #
+##########################
+
+# Aho-Corasick automaton over a dict of literal strings
+# search() finds every key whose string occurs in the text,
+# in a single pass over the text no matter how many strings there are
+class AhoCorasick:
+    def __init__(self, words):
+        # node 0 is the root, each node has its transitions, a fail link
+        # and the keys of every word ending at that node (incl. via fail links)
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for key in words:
+            node = 0
+            for ch in words[key]:
+                if ch not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                    self.goto[node][ch] = len(self.goto)-1
+                node = self.goto[node][ch]
+            self.out[node].append(key)
+        # breadth first, so a node's fail target is always finished before it
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                if node != 0 and ch in self.goto[f]:
+                    self.fail[child] = self.goto[f][ch]
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    # set of keys whose string appears somewhere in text
+    def search(self, text):
+        goto, fail, out = self.goto, self.fail, self.out
+        found = set(out[0])
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+# same value re.findall(pattern, text)[0] would give, or None,
+# without collecting every other match in the text first
+def firstFindall(pattern, text):
+    m = pattern.search(text)
+    if m is None:
+        return None
+    if pattern.groups == 0:
+        return m.group(0)
+    if pattern.groups == 1:
+        return m.group(1) or ''
+    return m.groups('')
+
+# longest literal string that every match of the regex has to contain,
+# or None if there isn't one we can be sure of
+# only walks the parts of the pattern that are mandatory
+# (plain sequences, groups, repeats with a minimum of at least one)
+def requiredLiteral(pattern):
+    try:
+        parsed = sre_parse.parse(pattern)
+    except (re.error, RecursionError):
+        return None
+    state = getattr(parsed, 'state', None) or getattr(parsed, 'pattern', None)
+    if state.flags & (re.IGNORECASE | re.LOCALE):
+        return None
+    runs = []
+    def walk(items):
+        run = []
+        for op, av in items:
+            if op == sre_constants.LITERAL:
+                run.append(chr(av))
+                continue
+            runs.append(''.join(run))
+            run = []
+            if op == sre_constants.SUBPATTERN:
+                add_flags, sub = av[1], av[-1]
+                if not add_flags & (re.IGNORECASE | re.LOCALE):
+                    walk(sub)
+            elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+                lo, hi, sub = av
+                if lo > 0:
+                    walk(sub)
+        runs.append(''.join(run))
+    walk(parsed)
+    best = max(runs, key=len)
+    return best or None
+
+# finds the first match of every regex in a dict {key: compiled pattern}
+# with a single scan of the text:
+#   an Aho-Corasick pass over each pattern's required literal picks out
+#   the few patterns that could possibly match, then only those are run
+# patterns without a usable literal are always run
+# match() gives the same values as re.findall(pattern, text)[0] per pattern
+class MultiPatternMatcher:
+    def __init__(self, patterns):
+        self.compiled = patterns
+        literals = {}
+        self.always = []
+        for key in patterns:
+            literal = requiredLiteral(patterns[key].pattern)
+            if literal is None:
+                self.always.append(key)
+            else:
+                literals[key] = literal
+        self.automaton = AhoCorasick(literals)
+
+    # dict of key -> first match, for every pattern found in text
+    # profiler: a PatternProfiler to time each pattern with, for --profile
+    def match(self, text, profiler=None):
+        if profiler is not None:
+            return self._profiledMatch(text, profiler)
+        candidates = self.automaton.search(text)
+        candidates.update(self.always)
+        found = {}
+        for key in candidates:
+            r_match = firstFindall(self.compiled[key], text)
+            if r_match is not None:
+                found[key] = r_match
+        return found
+
+    # dict of key -> number of (non-overlapping) matches, for every pattern
+    # found in text, where match() only keeps the first
+    def count(self, text):
+        candidates = self.automaton.search(text)
+        candidates.update(self.always)
+        counts = {}
+        for key in candidates:
+            n = sum(1 for m in self.compiled[key].finditer(text))
+            if n:
+                counts[key] = n
+        return counts
+
+    # same as match(), timing the literal search and each pattern run
+    # (patterns the literal search rules out aren't run, or counted)
+    def _profiledMatch(self, text, profiler):
+        start = time.perf_counter()
+        candidates = self.automaton.search(text)
+        profiler.record(prefilter_key, time.perf_counter()-start, bool(candidates))
+        candidates.update(self.always)
+        found = {}
+        for key in candidates:
+            start = time.perf_counter()
+            r_match = firstFindall(self.compiled[key], text)
+            profiler.record(key, time.perf_counter()-start, r_match is not None)
+            if r_match is not None:
+                found[key] = r_match
+        return found
+
+#############
+# Profiling #
+#############
+
+# what the profile calls the literal search of MultiPatternMatcher
+prefilter_key = '(literal prefilter)'
+
+# calls, hits and seconds spent for each pattern key, for --profile
+# only used when a run asks for it, the normal match path never sees it
+class PatternProfiler:
+    def __init__(self):
+        self.stats = {}
+
+    def record(self, key, seconds, hit):
+        stat = self.stats.get(key)
+        if stat is None:
+            stat = self.stats[key] = [0, 0, 0.0]
+        stat[0] += 1
+        if hit:
+            stat[1] += 1
+        stat[2] += seconds
+
+    # hand over everything recorded so far and start again
+    # (worker processes send this back with each batch)
+    def take(self):
+        stats = self.stats
+        self.stats = {}
+        return stats
+
+    def merge(self, stats):
+        for key in stats:
+            calls, hits, seconds = stats[key]
+            stat = self.stats.get(key)
+            if stat is None:
+                stat = self.stats[key] = [0, 0, 0.0]
+            stat[0] += calls
+            stat[1] += hits
+            stat[2] += seconds
+
+    # one dict per key, the most time spent first
+    # patterns: the pattern dict, to show each key's pattern alongside it
+    def report(self, patterns=None):
+        rows = []
+        for key in sorted(self.stats, key=lambda k: -self.stats[k][2]):
+            calls, hits, seconds = self.stats[key]
+            rows.append({
+                'key': key,
+                'pattern': patterns.get(key) if patterns else None,
+                'calls': calls,
+                'hits': hits,
+                'seconds': seconds,
+                'us_per_call': seconds/calls*1000000,
+                'hit_rate': hits/calls,
+            })
+        return rows
+
+    # report() as json if path ends in .json, csv otherwise
+    def save(self, path, patterns=None):
+        rows = self.report(patterns)
+        with open(path, 'w', newline='') as f:
+            if path.endswith('.json'):
+                json.dump(rows, f, indent=2)
+            else:
+                writer = csv.DictWriter(f, ['key','pattern','calls','hits',
+                    'seconds','us_per_call','hit_rate'])
+                writer.writeheader()
+                writer.writerows(rows)
+        return rows
+
+####################
+# Pattern registry #
+####################
+
+# one entry of a pattern dict, compiled
+# position is the first letter of the key (A, B, C, D...)
+class CompiledPattern:
+    def __init__(self, key, position, pattern, compiled):
+        self.key = key
+        self.position = position
+        self.pattern = pattern
+        self.compiled = compiled
+
+# compiles every entry of a {"<position> name": pattern} dict exactly once
+# patterns for the anchored positions get compiled with a leading "^",
+# the ones for the anywhere position also go into a MultiPatternMatcher
+# anything that doesn't compile is left out and kept in errors
+class PatternRegistry:
+    def __init__(self, patterns, anchored=('A',), anywhere='C'):
+        self.entries = []
+        self.errors = []
+        for key in patterns:
+            position = key[0]
+            pattern = patterns[key]
+            if position in anchored:
+                source = r"^"+pattern
+            else:
+                source = pattern
+            try:
+                compiled = re.compile(source)
+            except re.error as e:
+                self.errors.append((key, pattern, str(e)))
+                continue
+            self.entries.append(CompiledPattern(key, position, pattern, compiled))
+        self.anywhere = MultiPatternMatcher(
+            {e.key: e.compiled for e in self.entries if e.position == anywhere})
+
+    def __len__(self):
+        return len(self.entries)
+
+    # print every pattern that failed to compile
+    def reportErrors(self):
+        for key, pattern, error in self.errors:
+            print('Could not compile pattern',repr(key),':',repr(pattern),'-',error)
+        sys.stdout.flush()
+
+###########
+# Lexicon #
+###########
+
+# words in a cleaned text, keeping inner apostrophes (you're, mate's)
+token_regex = re.compile(r"\w+(?:'\w+)*")
+
+def tokenize(text):
+    return token_regex.findall(text)
+
+# where the first sentence ends, for the B position class
+sentence_end = re.compile(r'[.?!]')
+
+# one text as every matcher sees it
+# clean: the tool's cleanText, run the first time the text is asked for
+# the regions the position classes look in are worked out the first time
+# a pattern needs them and kept, so each is done at most once per text
+class TextView:
+    def __init__(self, raw, clean):
+        self.raw = raw
+        self.clean = clean
+        self._text = None
+        self._first_sentence = None
+        self._first_words = {}
+        self._tokens = None
+
+    # the cleaned text
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.clean(self.raw)
+        return self._text
+
+    # up to the first . ? or !
+    @property
+    def first_sentence(self):
+        if self._first_sentence is None:
+            self._first_sentence = sentence_end.split(self.text, 1)[0]
+        return self._first_sentence
+
+    # the first n space separated words, joined back up
+    def firstWords(self, n):
+        if n not in self._first_words:
+            self._first_words[n] = ' '.join(self.text.split(' ', n)[:n])
+        return self._first_words[n]
+
+    @property
+    def tokens(self):
+        if self._tokens is None:
+            self._tokens = tokenize(self.text)
+        return self._tokens
+
+# LIWC-style word lists, one entry per line:
+#   "friend"  matches the token friend
+#   "friend*" matches any token starting with friend
+# exact entries live in a dict, wildcard entries in a prefix trie,
+# so matching a text is one lookup + one trie walk per token
+# however many entries are loaded
+class Lexicon:
+    # entries the trie can handle: one word, optionally ending in *
+    entry_regex = re.compile(r"[\w']+\*?")
+
+    def __init__(self):
+        self.entries = []
+        # category names (lexicon file names) for each entry
+        self.categories = []
+        self.index = {}
+        self.exact = {}
+        # nested dicts keyed on characters, '' holds the ids ending there
+        self.trie = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    # add one entry, returns False if it isn't a plain word or word*
+    def addEntry(self, entry, category):
+        entry = entry.strip().lower()
+        if not self.entry_regex.fullmatch(entry):
+            return False
+        if entry in self.index:
+            if category not in self.categories[self.index[entry]]:
+                self.categories[self.index[entry]].append(category)
+            return True
+        entry_id = len(self.entries)
+        self.entries.append(entry)
+        self.categories.append([category])
+        self.index[entry] = entry_id
+        if entry.endswith('*'):
+            node = self.trie
+            for ch in entry[:-1]:
+                node = node.setdefault(ch, {})
+            node.setdefault('', []).append(entry_id)
+        else:
+            self.exact.setdefault(entry, []).append(entry_id)
+        return True
+
+    # load a lexicon file, category is the file name without extension
+    # returns the lines that couldn't be added as entries
+    def addFile(self, filename):
+        category = os.path.splitext(os.path.basename(filename))[0]
+        rejected = []
+        with open(filename,'r') as f:
+            for line in f:
+                entry = line.strip()
+                if entry and not self.addEntry(entry, category):
+                    rejected.append(entry)
+        return rejected
+
+    # ids of every entry the token matches
+    def lookup(self, token):
+        ids = list(self.exact.get(token, ()))
+        node = self.trie
+        if '' in node:
+            ids += node['']
+        for ch in token:
+            node = node.get(ch)
+            if node is None:
+                break
+            if '' in node:
+                ids += node['']
+        return ids
+
+    # dict of entry id -> first token that matched it
+    def match(self, tokens):
+        found = {}
+        seen = set()
+        for token in tokens:
+            if token in seen:
+                continue
+            seen.add(token)
+            for entry_id in self.lookup(token):
+                if entry_id not in found:
+                    found[entry_id] = token
+        return found
+
+    # dict of entry id -> how many tokens matched it, every occurrence counted
+    def count(self, tokens):
+        counts = {}
+        for token, n in collections.Counter(tokens).items():
+            for entry_id in self.lookup(token):
+                counts[entry_id] = counts.get(entry_id, 0)+n
+        return counts
+
+####################
+# Parallel helpers #
+####################
+
+# how --workers pools start their processes
+# a pool starts them on its first submit, from the match stage while the
+# fetch thread is reading, and forking a process with other threads
+# running can deadlock the child, so they start from a clean forkserver
+# process instead (spawn where there is none) and get everything
+# they need through the pool's initializer or by importing the tool
+def workerContext():
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+# the biggest peak RSS in KB any pool worker has reported so far, for --stats
+# the workers aren't our children under forkserver, so RUSAGE_CHILDREN
+# never sees them and they send it back with each result instead
+_worker_rss = {'peak': None}
+_worker_rss_lock = threading.Lock()
+
+# fn(item) in a worker process, along with the worker's peak RSS so far
+def _withPeakRSS(fn, item):
+    return fn(item), ownPeakRSS()
+
+def _poolResult(future):
+    result, rss = future.result()
+    if rss is not None:
+        with _worker_rss_lock:
+            _worker_rss['peak'] = max(rss, _worker_rss['peak'] or 0)
+    return result
+
+# run fn on each item in a concurrent.futures pool,
+# yielding (item, result) pairs in the same order as the items
+# at most `ahead` items are in flight at once, so memory stays bounded
+# and the next items are being produced while earlier ones are worked on
+def orderedPoolMap(pool, fn, items, ahead):
+    task = functools.partial(_withPeakRSS, fn)
+    pending = collections.deque()
+    for item in items:
+        pending.append((item, pool.submit(task, item)))
+        if len(pending) >= ahead:
+            item, future = pending.popleft()
+            yield item, _poolResult(future)
+    while pending:
+        item, future = pending.popleft()
+        yield item, _poolResult(future)
+
+############
+# Pipeline #
+############
+
+# marks the end of the items on a pipeline queue
+_end_of_stream = object()
+
+# a chain of stages, each running in its own thread and connected
+# to the next one by a bounded queue, so at most queue_size items
+# wait between any two stages
+# the source is any iterable, every other stage is a function that takes
+# an iterator of items and yields the items for the next stage
+# for each stage we keep how long it spent working and how long it sat
+# waiting on the stages around it
+class Pipeline:
+    def __init__(self, queue_size=2):
+        self.queue_size = queue_size
+        self.stages = []
+        self.stats = collections.OrderedDict()
+        self.errors = []
+        self.failed = threading.Event()
+        # perf_counter() when run() started
+        self.started = None
+
+    def addSource(self, name, items):
+        self.stages.append((name, None, items))
+
+    def addStage(self, name, fn):
+        self.stages.append((name, fn, None))
+
+    # queue get/put that give up once another stage has failed
+    # (_put then returns False, the item was never passed on)
+    def _put(self, q, item):
+        while not self.failed.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self.failed.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _end_of_stream
+
+    def _inputs(self, q, stat):
+        while True:
+            start = time.perf_counter()
+            item = self._get(q)
+            stat['wait'] += time.perf_counter()-start
+            if item is _end_of_stream:
+                return
+            yield item
+
+    def _runStage(self, name, fn, items, inq, outq):
+        stat = self.stats[name]
+        start = time.perf_counter()
+        try:
+            if fn is not None:
+                items = fn(self._inputs(inq, stat))
+            for item in items:
+                if stat['items'] == 0:
+                    stat['first'] = time.perf_counter()-self.started
+                stat['items'] += 1
+                if outq is not None:
+                    put_start = time.perf_counter()
+                    sent = self._put(outq, item)
+                    stat['wait'] += time.perf_counter()-put_start
+                    # a later stage failed, stop here rather than
+                    # reading or working through everything left
+                    if not sent:
+                        break
+            # run the stage's finally blocks now (e.g. closing its cursor)
+            if hasattr(items, 'close'):
+                items.close()
+        except BaseException as e:
+            self.errors.append(e)
+            self.failed.set()
+        finally:
+            if outq is not None:
+                self._put(outq, _end_of_stream)
+            stat['total'] = time.perf_counter()-start
+            stat['busy'] = stat['total']-stat['wait']
+
+    # run every stage to completion, re-raising the first error if any
+    # stats[name]['first'] is when the stage passed on its first item,
+    # in seconds after the start of run()
+    def run(self):
+        threads = []
+        inq = None
+        self.started = time.perf_counter()
+        for i, (name, fn, items) in enumerate(self.stages):
+            self.stats[name] = {'items': 0, 'busy': 0.0, 'wait': 0.0, 'total': 0.0,
+                                'first': None}
+            outq = None
+            if i < len(self.stages)-1:
+                outq = queue.Queue(self.queue_size)
+            threads.append(threading.Thread(target=self._runStage,
+                args=(name, fn, items, inq, outq), name=name, daemon=True))
+            inq = outq
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if self.errors:
+            raise self.errors[0]
+
+    # seconds from since, a time.perf_counter() value from before run(),
+    # until stage name passed on its first item (None if it never did)
+    def firstItemTime(self, name, since):
+        first = self.stats[name]['first']
+        if first is None:
+            return None
+        return self.started-since+first
+
+    def printTimings(self):
+        print('Stage timings (seconds):')
+        for name in self.stats:
+            stat = self.stats[name]
+            print('  {:<10} busy {:9.2f}  waiting {:9.2f}  items {}'.format(
+                name, stat['busy'], stat['wait'], stat['items']))
+        sys.stdout.flush()
+
+#########
+# Cache #
+#########
+
+# what LRUCache.get() returns for keys it doesn't have
+# (None is a perfectly good value to cache, e.g. "this post has no text")
+missing = object()
+
+# dict-like cache holding at most max_size entries,
+# dropping the least recently used one when full
+# keeps hit and miss counts for get()
+class LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        if key in self.data:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return self.data[key]
+        self.misses += 1
+        return missing
+
+    def put(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def stats(self):
+        return {'size': len(self.data), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses}
+
+# split a list into lists of at most size items
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+#################
+# Deduplication #
+#################
+
+# 16 byte digest of a (cleaned) text
+def textDigest(text):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+# dataset-wide duplicate text elimination, one post at a time
+# only a 16 byte digest of each text is kept, plus whether the copy that
+# was kept has a parent:
+#   first copy of a text: kept
+#   later copy: dropped, unless it has a parent and the kept copy doesn't,
+#   then it's kept too and the digest goes into superseded, so the
+#   parentless copy can be dropped from the output at the end of the run
+#   (see dropSuperseded)
+# once the digests take more than max_memory bytes they are spilled to
+# sorted run files and looked up there, in a temp dir of their own
+# (inside spill_dir if given, so dedupers side by side never share files)
+class TextDeduper:
+    # bytes per spilled record: digest + has-parent flag
+    record_size = 17
+    # merge the run files once there are more than this many
+    max_runs = 8
+
+    # journal: optional file every kept digest is appended to, so the
+    # state can be rebuilt by a later run (see commitJournal)
+    # journal_bytes: replay that many bytes of an existing journal first
+    def __init__(self, max_memory=512*1024*1024, spill_dir=None,
+            journal=None, journal_bytes=None):
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        self.run_dir = None
+        self.seen = {}
+        self.superseded = set()
+        self.runs = []
+        self.run_count = 0
+        self.kept = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.journal = None
+        self.pending = []
+        if journal is not None:
+            if journal_bytes is not None:
+                # truncate() would pad a short journal with zero digests
+                if journal_bytes > os.path.getsize(journal):
+                    raise ValueError(journal+' is shorter than its checkpoint says')
+                self._replay(journal, journal_bytes)
+                self.journal = open(journal, 'r+b')
+                self.journal.truncate(journal_bytes)
+                self.journal.seek(journal_bytes)
+            else:
+                self.journal = open(journal, 'wb')
+
+    # b'\x00'/b'\x01' for digests we've seen, None if new
+    def _lookup(self, digest):
+        flag = self.seen.get(digest)
+        if flag is not None:
+            return flag
+        for run in reversed(self.runs):
+            flag = self._searchRun(run[1], digest)
+            if flag is not None:
+                return flag
+        return None
+
+    def _searchRun(self, mm, digest):
+        size = self.record_size
+        lo, hi = 0, len(mm)//size
+        while lo < hi:
+            mid = (lo+hi)//2
+            found = mm[mid*size:mid*size+16]
+            if found < digest:
+                lo = mid+1
+            elif found > digest:
+                hi = mid
+            else:
+                return mm[mid*size+16:mid*size+17]
+        return None
+
+    # True if this copy of the text should be written
+    def check(self, text, has_parent):
+        digest = textDigest(text)
+        previous = self._lookup(digest)
+        if previous is None or (previous == b'\x00' and has_parent):
+            flag = b'\x01' if has_parent else b'\x00'
+            self._keep(digest, flag, previous)
+            if self.journal is not None:
+                self.pending.append(digest+flag)
+            return True
+        self.dropped += 1
+        return False
+
+    def _keep(self, digest, flag, previous):
+        if previous is not None:
+            self.superseded.add(digest)
+        self.seen[digest] = flag
+        self.kept += 1
+        # superseded stays in memory (dropSuperseded needs all of it),
+        # so only what spilling would free counts here
+        if len(self.seen) % 4096 == 0 and self._seenMemory() > self.max_memory:
+            self._spill()
+
+    # write out the digests kept since the last call and get them onto
+    # disk before the checkpoint that records the size does,
+    # returns the journal size to store in a checkpoint
+    def commitJournal(self):
+        if self.journal is None:
+            return None
+        self.journal.write(b''.join(self.pending))
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.pending = []
+        return self.journal.tell()
+
+    def _replay(self, journal, journal_bytes):
+        size = self.record_size
+        with open(journal, 'rb') as f:
+            data = f.read(journal_bytes)
+        for pos in range(0, len(data)-size+1, size):
+            digest, flag = data[pos:pos+16], data[pos+16:pos+17]
+            self._keep(digest, flag, self._lookup(digest))
+
+    def _spill(self):
+        if self.run_dir is None:
+            self.run_dir = tempfile.mkdtemp(prefix='dedup_', dir=self.spill_dir)
+        self._writeRun(sorted(self.seen.items()))
+        self.spilled += len(self.seen)
+        self.seen = {}
+        if len(self.runs) > self.max_runs:
+            # newer runs win for digests that show up in more than one
+            records = heapq.merge(*[self._records(i, run[1])
+                                    for i, run in enumerate(self.runs)])
+            old_runs = self.runs
+            self.runs = []
+            # streamed straight into the new run, never all in memory
+            self._writeRun(self._newest(records))
+            for path, mm, f in old_runs:
+                mm.close()
+                f.close()
+                os.remove(path)
+
+    # (digest, -run number, flag) so newer runs sort first per digest
+    def _records(self, i, mm):
+        size = self.record_size
+        for pos in range(0, len(mm), size):
+            yield mm[pos:pos+16], -i, mm[pos+16:pos+17]
+
+    # (digest, flag) for the first, newest, record of each digest
+    # in merged (digest, -run number, flag) order
+    @staticmethod
+    def _newest(records):
+        last = None
+        for digest, newest, flag in records:
+            if digest != last:
+                last = digest
+                yield digest, flag
+
+    def _writeRun(self, records):
+        path = os.path.join(self.run_dir, 'run_{}.bin'.format(self.run_count))
+        self.run_count += 1
+        with open(path, 'wb') as f:
+            for digest, flag in records:
+                f.write(digest+flag)
+        f = open(path, 'rb')
+        self.runs.append((path, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), f))
+
+    # rough size in bytes of the digests not spilled yet
+    def _seenMemory(self):
+        return sys.getsizeof(self.seen)+len(self.seen)*self._digestSize()
+
+    # rough size in bytes of what we keep in memory
+    def memoryUsage(self):
+        return (self._seenMemory()+sys.getsizeof(self.superseded)+
+                len(self.superseded)*self._digestSize())
+
+    @staticmethod
+    def _digestSize():
+        return sys.getsizeof(bytes(16))
+
+    def stats(self):
+        return {'kept': self.kept, 'dropped': self.dropped,
+                'superseded': len(self.superseded),
+                'in_memory': len(self.seen), 'spilled': self.spilled,
+                'run_files': len(self.runs), 'memory_bytes': self.memoryUsage()}
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+        for path, mm, f in self.runs:
+            mm.close()
+            f.close()
+            os.remove(path)
+        self.runs = []
+        if self.run_dir is not None:
+            os.rmdir(self.run_dir)
+            self.run_dir = None
+
+# rewrite a csv output without the parentless copies of superseded texts
+# text_column and parent_column are column numbers in the csv
+def dropSuperseded(csvfile, superseded, text_column, parent_column):
+    tmpfile = csvfile+'.tmp'
+    dropped = 0
+    compression = compressionOf(csvfile)
+    with openText(csvfile, 'r', compression) as fin, \
+            openText(tmpfile, 'w', compression) as fout:
+        reader = csv.reader(fin)
+        writer = csv.writer(fout, quoting=csv.QUOTE_ALL, lineterminator='\n')
+        writer.writerow(next(reader))
+        for row in reader:
+            if row[parent_column] == 'None' and textDigest(row[text_column]) in superseded:
+                dropped += 1
+                continue
+            writer.writerow(row)
+    os.replace(tmpfile, csvfile)
+    return dropped
+
+##########
+# Output #
+##########
+
+# output compression formats, by file extension
+compressors = {
+    'gz':   gzip,
+    'bz2':  bz2,
+    'xz':   lzma,
+}
+
+# compression format from a file name, None for plain text
+def compressionOf(path):
+    ext = path.rsplit('.', 1)[-1]
+    if ext in compressors:
+        return ext
+    return None
+
+# open a (possibly compressed) utf-8 text file for csv reading/writing
+def openText(path, mode, compression=None):
+    if compression is None:
+        return open(path, mode, encoding='utf-8', newline='')
+    return compressors[compression].open(path, mode+'t',
+                encoding='utf-8', newline='')
+
+# compressed binary stream written into an already open file object,
+# closing it finishes the compressed data but leaves fileobj open
+def compressInto(fileobj, compression):
+    if compression == 'gz':
+        return gzip.GzipFile(fileobj=fileobj, mode='wb')
+    if compression == 'bz2':
+        return bz2.BZ2File(fileobj, 'wb')
+    return lzma.LZMAFile(fileobj, 'wb')
+
+# csv output that stays open for the whole run
+# rows go through the csv module (every field quoted) into a large
+# write buffer, and through gzip/bz2/xz on the way if compression is set
+# (the extension is added to the file name)
+# resume: (byte offset, rows) from a checkpoint, cut the file back to
+# that offset and carry on writing after it
+class MatchWriter:
+    def __init__(self, path, header, compression=None, buffer_size=1024*1024,
+            resume=None):
+        if compression is not None:
+            path = path+'.'+compression
+        self.path = path
+        self.compression = compression
+        self.buffer_size = buffer_size
+        if resume is None:
+            self.rows = 0
+            self.raw = open(path, 'wb', buffering=0)
+            self._open()
+            self.writer.writerow(header)
+        else:
+            offset, self.rows = resume
+            if offset > os.path.getsize(path):
+                raise ValueError(path+' is shorter than its checkpoint says')
+            self.raw = open(path, 'r+b', buffering=0)
+            self.raw.truncate(offset)
+            self.raw.seek(offset)
+            self._open()
+
+    def _open(self):
+        if self.compression is None:
+            self.stream = None
+            buffered = io.BufferedWriter(self.raw, self.buffer_size)
+        else:
+            self.stream = compressInto(self.raw, self.compression)
+            buffered = io.BufferedWriter(self.stream, self.buffer_size)
+        self.text = io.TextIOWrapper(buffered, encoding='utf-8', newline='')
+        self.writer = csv.writer(self.text, quoting=csv.QUOTE_ALL, lineterminator='\n')
+
+    # flush everything down to raw and finish the compressed stream
+    # (detaching so the compression layer doesn't close raw)
+    def _close(self):
+        self.text.flush()
+        buffered = self.text.detach()
+        buffered.flush()
+        buffered.detach()
+        if self.stream is not None:
+            self.stream.close()
+
+    def writeRows(self, rows):
+        for row in rows:
+            self.writer.writerow(row)
+            self.rows += 1
+
+    # get every row so far onto disk and return the file size
+    # compressed output gets its stream finished and a new one started
+    # (gzip, bz2 and xz readers all read concatenated streams), so the
+    # file can always be cut back to the returned offset
+    def checkpoint(self):
+        if self.compression is None:
+            self.text.flush()
+        else:
+            self._close()
+        os.fsync(self.raw.fileno())
+        offset = self.raw.tell()
+        if self.compression is not None:
+            self._open()
+        return offset
+
+    def close(self):
+        self._close()
+        self.raw.close()
+
+    def stats(self):
+        return {'path': self.path, 'rows': self.rows,
+                'bytes': os.path.getsize(self.path)}
+
+##################
+# Count matrices #
+##################
+
+# the counts of one batch of posts, as the lists a CountWriter appends
+# (plain lists, so they can be sent back from a worker process)
+class BatchCounts:
+    def __init__(self):
+        self.keys = []
+        self.lengths = []
+        self.indices = []
+        self.counts = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    # counts: dict of column -> count for the post with this key
+    def add(self, key, counts):
+        self.keys.append(key)
+        self.lengths.append(len(counts))
+        for column in sorted(counts):
+            self.indices.append(column)
+            self.counts.append(counts[column])
+
+# --counts output: how often each pattern matched in each post, as a
+# posts x columns scipy CSR matrix in prefix.npz, along with
+#   prefix.rows.csv            the key of the post in each row
+#   prefix.columns.csv         the pattern in each column and its categories
+#   prefix.categories.npz      the same counts summed per category
+#   prefix.categories.csv      the category in each of its columns
+# batches go straight into the rows file and raw part files next to it,
+# the matrices are put together from those once, in close()
+# columns: the name of each column
+# column_categories: the list of categories for each column
+class CountWriter:
+    # C ints, numpy reads them back as dtype 'i'
+    typecode = 'i'
+
+    def __init__(self, prefix, key_header, columns, column_categories, resume=None):
+        self.prefix = prefix
+        self.columns = columns
+        self.column_categories = column_categories
+        self.rows_path = prefix+'.rows.csv'
+        self.part_paths = [prefix+'.part-'+name for name in ('lengths', 'indices', 'counts')]
+        if resume is None:
+            self.rows, self.nnz = 0, 0
+            self.rows_file = open(self.rows_path, 'w', newline='', encoding='utf-8')
+            csv.writer(self.rows_file).writerow(['row']+key_header)
+            self.parts = [open(path, 'wb') for path in self.part_paths]
+        else:
+            self.rows, self.nnz, offset = resume
+            self.rows_file = open(self.rows_path, 'r+', newline='', encoding='utf-8')
+            self.rows_file.truncate(offset)
+            self.rows_file.seek(offset)
+            self.parts = [open(path, 'r+b') for path in self.part_paths]
+            itemsize = array.array(self.typecode).itemsize
+            for f, items in zip(self.parts, (self.rows, self.nnz, self.nnz)):
+                if items*itemsize > os.path.getsize(f.name):
+                    raise ValueError(f.name+' is shorter than its checkpoint says')
+                f.truncate(items*itemsize)
+                f.seek(items*itemsize)
+        self.writer = csv.writer(self.rows_file)
+
+    def write(self, batch):
+        for key in batch.keys:
+            self.writer.writerow([self.rows]+list(key))
+            self.rows += 1
+        for f, items in zip(self.parts, (batch.lengths, batch.indices, batch.counts)):
+            array.array(self.typecode, items).tofile(f)
+        self.nnz += len(batch.indices)
+
+    # get everything so far onto disk, returns what resume= needs
+    def checkpoint(self):
+        for f in [self.rows_file]+self.parts:
+            f.flush()
+            os.fsync(f.fileno())
+        return [self.rows, self.nnz, self.rows_file.tell()]
+
+    # build and save the matrices, then drop the part files
+    def close(self):
+        self.rows_file.close()
+        for f in self.parts:
+            f.close()
+        lengths, indices, counts = [numpy.fromfile(path, dtype=self.typecode)
+                                    for path in self.part_paths]
+        indptr = numpy.zeros(self.rows+1, dtype=numpy.int64)
+        numpy.cumsum(lengths, out=indptr[1:])
+        matrix = sparse.csr_matrix((counts, indices, indptr),
+                    shape=(self.rows, len(self.columns)))
+        sparse.save_npz(self.prefix+'.npz', matrix)
+
+        # columns x categories, 1 where the column belongs to the category
+        categories = sorted(set(c for cs in self.column_categories for c in cs))
+        category_index = {c: i for i, c in enumerate(categories)}
+        pairs = [(column, category_index[c])
+                 for column, cs in enumerate(self.column_categories) for c in cs]
+        rollup = sparse.csr_matrix(
+            (numpy.ones(len(pairs), dtype=matrix.dtype),
+                ([p[0] for p in pairs], [p[1] for p in pairs])),
+            shape=(len(self.columns), len(categories)))
+        sparse.save_npz(self.prefix+'.categories.npz', (matrix @ rollup).tocsr())
+
+        with open(self.prefix+'.columns.csv', 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['column', 'pattern', 'categories'])
+            for i, column in enumerate(self.columns):
+                writer.writerow([i, column, ';'.join(self.column_categories[i])])
+        with open(self.prefix+'.categories.csv', 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['column', 'category'])
+            for i, category in enumerate(categories):
+                writer.writerow([i, category])
+        for path in self.part_paths:
+            removeFile(path)
+
+    def stats(self):
+        return {'path': self.prefix+'.npz', 'rows': self.rows,
+                'columns': len(self.columns), 'nonzero': self.nnz}
+
+##############
+# File input #
+##############
+
+# records of a JSONL or CSV dump, optionally .gz/.bz2/.xz compressed,
+# one dict per post/tweet, read as a stream
+# csv dumps have a header row naming the fields, and give every value as a string
+def readRecords(path):
+    compression = compressionOf(path)
+    name = path[:-len(compression)-1] if compression else path
+    with openText(path, 'r', compression) as f:
+        if name.endswith('.csv'):
+            # post texts can be far longer than csv's default field limit
+            csv.field_size_limit(2**31-1)
+            for record in csv.DictReader(f):
+                yield record
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+# an id from a dump, which might be a number, a numeric string,
+# or null/empty/"None" for no id
+def intOrNone(value):
+    if value is None or value in ('', 'None', 'null', 'NULL'):
+        return None
+    return int(value)
+
+# texts of every post/tweet in a dump, keyed on a tuple of ids,
+# kept in a temporary sqlite file instead of memory, so parent texts
+# can be looked up while the same dump is streamed through the matchers
+# each text can also have the id of the one it replies to stored with it
+class TextIndex:
+    def __init__(self, tmp_dir=None):
+        fd, self.path = tempfile.mkstemp(prefix='textindex_', suffix='.sqlite',
+                            dir=tmp_dir)
+        os.close(fd)
+        # built in main(), read from the parents stage
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('create table texts (id text primary key, text text, parent)')
+        self.size = 0
+
+    @staticmethod
+    def _id(key):
+        return ','.join(str(k) for k in key)
+
+    # items: (key, text) pairs, or (key, text, parent) to keep what each
+    # text replies to as well, the first text for a key is kept
+    def build(self, items):
+        with self.conn:
+            self.conn.executemany(
+                'insert or ignore into texts values (?,?,?)',
+                ((self._id(item[0]), item[1], item[2] if len(item) > 2 else None)
+                    for item in items))
+        self.size = self.conn.execute('select count(*) from texts').fetchone()[0]
+
+    # dict of key -> text for the keys that are in the index,
+    # or key -> (text, parent) with parents
+    def fetch(self, keys, parents=False):
+        ids = {self._id(key): key for key in keys}
+        texts = {}
+        # sqlite allows 999 parameters per query
+        for chunk in chunks(list(ids), 500):
+            query = 'select id, text, parent from texts where id in ({})'.format(
+                        ','.join('?'*len(chunk)))
+            for id, text, parent in self.conn.execute(query, chunk):
+                texts[ids[id]] = (text, parent) if parents else text
+        return texts
+
+    def close(self):
+        self.conn.close()
+        removeFile(self.path)
+
+############
+# Datasets #
+############
+
+# dataset ids from the command line: one id, a range, or a comma separated
+# list of both, e.g. "3", "1-40" or "1-5,9,12", in the order given
+def datasetIds(text):
+    ids = []
+    for part in text.split(','):
+        first, _, last = part.strip().partition('-')
+        if last:
+            ids.extend(range(int(first), int(last)+1))
+        else:
+            ids.append(int(first))
+    if not ids:
+        raise ValueError(text)
+    return list(collections.OrderedDict.fromkeys(ids))
+
+# one file per dataset for options given once for a run of several,
+# the dataset id goes before the extension: stats.json -> stats_3.json
+def datasetPath(path, dataset_id):
+    root, ext = os.path.splitext(path)
+    return '{}_{}{}'.format(root, dataset_id, ext)
+
+##########
+# Shards #
+##########
+
+# --shard i/N from the command line as (i, N), shards numbered from 1
+def shardSpec(text):
+    shard, _, shards = text.partition('/')
+    shard, shards = int(shard), int(shards)
+    if not 1 <= shard <= shards:
+        raise ValueError(text)
+    return shard, shards
+
+# where shard i of N writes what a whole run would write to path:
+# matches.csv -> matches.shard-2-of-4.csv
+def shardPath(path, shard, shards):
+    root, ext = os.path.splitext(path)
+    return '{}.shard-{}-of-{}{}'.format(root, shard, shards, ext)
+
+# each shard leaves path.done when it finishes, holding its settings,
+# and where its output went:
+#   {'settings': ..., 'path': ..., 'rows': ..., 'counts': [shard prefix, prefix]}
+# returns the .done contents of all N shards of path, or raises ValueError
+# if one is missing/unfinished or was run with other settings than shard 1
+def finishedShards(path, shards):
+    done = []
+    for shard in range(1, shards+1):
+        shard_path = shardPath(path, shard, shards)
+        state = loadCheckpoint(shard_path+'.done')
+        if state is None:
+            raise ValueError(shard_path+' is missing or its run hasn\'t finished')
+        if state['settings'].get('shard') != [shard, shards]:
+            raise ValueError(shard_path+'.done is for another shard')
+        done.append(state)
+    settings = [dict((k, v) for k, v in state['settings'].items() if k != 'shard')
+                for state in done]
+    for shard, other in enumerate(settings[1:], 2):
+        if other != settings[0]:
+            raise ValueError('shard {} of {} was run with other settings than shard 1 '
+                '(dataset, patterns, word range or compression)'.format(shard, shards))
+    return done
+
+# csv outputs each sorted on key(row), merged into one stream of
+# (key, rows) in key order, the rows of a key (one post's matches) together
+def mergeSortedRows(paths, key):
+    files = [openText(path, 'r', compressionOf(path)) for path in paths]
+    try:
+        readers = []
+        for f in files:
+            reader = csv.reader(f)
+            next(reader)
+            readers.append(reader)
+        for k, rows in itertools.groupby(heapq.merge(*readers, key=key), key=key):
+            yield k, list(rows)
+    finally:
+        for f in files:
+            f.close()
+
+# put the --counts output of every shard back together in prefix,
+# with the rows in key order like a single run, returns the number of rows
+def mergeCounts(prefixes, prefix):
+    keys = []
+    matrices = []
+    rollups = []
+    for shard_prefix in prefixes:
+        matrices.append(sparse.load_npz(shard_prefix+'.npz'))
+        rollups.append(sparse.load_npz(shard_prefix+'.categories.npz'))
+        with open(shard_prefix+'.rows.csv', newline='', encoding='utf-8') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            keys.extend(tuple(int(v) for v in row[1:]) for row in reader)
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    sparse.save_npz(prefix+'.npz', sparse.vstack(matrices).tocsr()[order])
+    sparse.save_npz(prefix+'.categories.npz', sparse.vstack(rollups).tocsr()[order])
+    with open(prefix+'.rows.csv', 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for row, i in enumerate(order):
+            writer.writerow([row]+list(keys[i]))
+    # the columns are the same for every shard
+    for name in ('.columns.csv', '.categories.csv'):
+        shutil.copyfile(prefixes[0]+name, prefix+name)
+    return len(keys)
+
+##############
+# Checkpoint #
+##############
+
+# hash of everything that decides what gets matched,
+# a checkpoint is only good for the patterns it was made with
+def hashPatterns(*parts):
+    data = json.dumps(parts, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+# hashPatterns() plus the contents of every pattern file, in the order given
+# (the order decides lexicon entry ids and the order patterns are tried in)
+def hashPatternFiles(paths, *parts):
+    digest = hashlib.sha256(hashPatterns(*parts).encode('utf-8'))
+    for path in paths:
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest.update(os.path.basename(path).encode('utf-8')+b'\0')
+        digest.update(hashlib.sha256(data).digest())
+    return digest.hexdigest()
+
+# things that are slow to build (reflected tables, compiled patterns)
+# pickled along with the key they were built for,
+# loadPickleCache gives None if the file is missing or for another key
+def loadPickleCache(path, key):
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        cached = pickle.load(f)
+    if cached['key'] != key:
+        return None
+    return cached['value']
+
+def savePickleCache(path, key, value):
+    tmp = path+'.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump({'key': key, 'value': value}, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+# checkpoints are small json files, replaced atomically
+def saveCheckpoint(path, state):
+    tmp = path+'.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def loadCheckpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def removeFile(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+#############
+# Run stats #
+#############
+
+# peak resident set size in KB of this process, None without the resource module
+def ownPeakRSS():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS counts bytes, Linux KB
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+# peak RSS of this process, and of the biggest of the --workers processes
+# (None without a pool), see orderedPoolMap()
+def peakRSS():
+    with _worker_rss_lock:
+        return ownPeakRSS(), _worker_rss['peak']
+
+# --stats: how long the run and each pipeline stage took, how much
+# it wrote and how much memory it needed, as json (see benchmark.py)
+# started: time.perf_counter() at the start of the run
+def saveStats(path, tool, started, pipeline, writer, **extra):
+    own, children = peakRSS()
+    stats = {
+        'tool': tool,
+        'seconds': time.perf_counter()-started,
+        'rows': writer.rows,
+        'stages': pipeline.stats,
+        'peak_rss_kb': own,
+        'workers_peak_rss_kb': children,
+    }
+    stats.update(extra)
+    with open(path, 'w') as f:
+        json.dump(stats, f, indent=2)
+
+#####################
+# Running a dataset #
+#####################
+
+# what runDataset() and mergeShards() need from a tool: how to fetch, match
+# and find the parents of its posts/tweets, and what its output looks like
+# checkpoints, --resume, --incremental, --shard, --counts and --stats are
+# the same for all three tools and are taken care of here
+# name: for --stats, e.g. 'regexMatchTool'
+# unit: what one row is, 'post' or 'tweet'
+# output_file(dataset_id): the csv a dataset's matches go to
+# header(settings): the csv header for a run with these settings
+# key(row): a fetched row's place in the dataset, e.g. (discussion_id, post_id)
+# csv_key(row): the same from a row of the csv, for --merge
+# settings(): what else a checkpoint is only good for (pattern hash, word range...)
+# create_session(eng): a session on the tool's tables
+# fetch(session, dataset_id, last_key, since, until, shard): chunks of rows in key order
+# fetch_file(path, last_key): the same from an --input dump
+# index_file(path, tmp_dir): a TextIndex of an --input dump for fetch_indexed
+# high_water_mark(session, dataset_id): where --incremental scans up to
+# fetch_parents(keys, session, dataset_id), fetch_indexed(keys, index):
+#   parent texts from the database or the --input index
+# match(batches, pool, workers): the match stage, yields (rows, matches, counts)
+# add_parents(matches, fetch, cache): fills in the parents of one chunk's matches
+# in_range(row): False for a fetched row outside the word range, None for no word range
+# report_lengths(session, dataset_id, length_counts, last_key, since, until, shard):
+#   prints what the word range filtered out
+# dedup(matches, deduper): drops duplicate texts, None to keep them all
+# dedup_columns: the (text, parent id) csv columns for dropSuperseded()
+# key_header, count_columns(): the key columns and (columns, categories)
+#   for --counts, count_columns None for a tool without it
+class MatchTool:
+    def __init__(self, name, unit, output_file, header, key, csv_key, settings,
+            create_session, fetch, fetch_file, index_file, high_water_mark,
+            fetch_parents, fetch_indexed, match, add_parents, in_range=None,
+            report_lengths=None, dedup=None, dedup_columns=None,
+            key_header=None, count_columns=None):
+        self.name = name
+        self.unit = unit
+        self.output_file = output_file
+        self.header = header
+        self.key = key
+        self.csv_key = csv_key
+        self.settings = settings
+        self.create_session = create_session
+        self.fetch = fetch
+        self.fetch_file = fetch_file
+        self.index_file = index_file
+        self.high_water_mark = high_water_mark
+        self.fetch_parents = fetch_parents
+        self.fetch_indexed = fetch_indexed
+        self.match = match
+        self.add_parents = add_parents
+        self.in_range = in_range
+        self.report_lengths = report_lengths
+        self.dedup = dedup
+        self.dedup_columns = dedup_columns
+        self.key_header = key_header
+        self.count_columns = count_columns
+
+# each stage takes an iterator of chunks of rows and yields them on to the next
+
+# keeps a dataset's length_counts up to date, for report_lengths:
+# the rows the fetch stage got, and how many of those the exact
+# word count still rejected after the length filter in the query
+def countFetched(batches, length_counts, in_range=None):
+    try:
+        for rows in batches:
+            length_counts['fetched'] += len(rows)
+            if in_range is not None:
+                length_counts['rejected'] += sum(1 for row in rows if not in_range(row))
+            yield rows
+    finally:
+        # stops the source too when the pipeline closes this
+        if hasattr(batches, 'close'):
+            batches.close()
+
+# drops duplicate texts, passing on how far the dedup journal got with
+# each chunk, then fills in the parents of what's left
+# a --shard run has no deduper, duplicates are only dropped by --merge
+def resolveParents(batches, add_parents, fetch, cache, dedup=None, deduper=None):
+    for rows, matches, counts in batches:
+        dedup_bytes = None
+        if deduper is not None:
+            matches = dedup(matches, deduper)
+            dedup_bytes = deduper.commitJournal()
+        matches = add_parents(matches, fetch, cache)
+        yield rows, matches, counts, dedup_bytes
+
+# once batch_size rows are written, checkpoint where to carry on from
+# with --resume (after every chunk would be a lot of fsyncs)
+# checkpoint holds the settings it's only valid for (dataset, patterns...)
+# counter: the CountWriter for --counts
+def writeBatches(batches, tool, writer, checkpoint_file, checkpoint, batch_size,
+        counter=None):
+    # rows written since the last checkpoint, and the first of them
+    written, first_key = 0, None
+    for rows, matches, counts, dedup_bytes in batches:
+        # one csv row per match string
+        writer.writeRows(row for m in matches for row in m.rows())
+        if counter is not None:
+            counter.write(counts)
+        if first_key is None:
+            first_key = tool.key(rows[0])
+        written += len(rows)
+        if written >= batch_size:
+            last_key = tool.key(rows[-1])
+            print('Wrote dataset',checkpoint['dataset_id'],'matches from',tool.unit,
+                first_key,'to',last_key)
+            sys.stdout.flush()
+            checkpoint['last_key'] = last_key
+            checkpoint['offset'] = writer.checkpoint()
+            checkpoint['rows'] = writer.rows
+            checkpoint['dedup_bytes'] = dedup_bytes
+            if counter is not None:
+                checkpoint['count_state'] = counter.checkpoint()
+            saveCheckpoint(checkpoint_file, checkpoint)
+            written, first_key = 0, None
+        yield rows
+
+# everything for one dataset, from its checkpoint to its stats
+# args: the tool's command line
+# eng: the database engine, None with --input
+# pool: the --workers pool, None without
+# several: more than one dataset in this run, so --stats and --counts
+# get one set of files each, with the dataset id in their names
+# started: what its timings count from, when it starts if not given
+def runDataset(dataset_id, tool, args, eng, pool, several=False, started=None):
+    if started is None:
+        started = time.perf_counter()
+    if eng is not None:
+        session = tool.create_session(eng)
+    else:
+        session = None
+    # rows fetched and rejected by the word count, see countFetched()
+    length_counts = {'fetched': 0, 'rejected': 0}
+    # parent texts kept across batches, so a parent replied to
+    # over and over is fetched once
+    parent_cache = LRUCache(args.parent_cache)
+    counts_prefix = None
+    if tool.count_columns is not None and args.counts is not None:
+        counts_prefix = datasetPath(args.counts, dataset_id) if several else args.counts
+
+    # what file to write to, kept open for the whole run
+    csvfile = tool.output_file(dataset_id)
+    # a shard writes files of its own, --merge puts them together
+    # into the ones a single run would have written
+    merged_counts = counts_prefix
+    if args.shard is not None:
+        csvfile = shardPath(csvfile, *args.shard)
+        if counts_prefix is not None:
+            counts_prefix = shardPath(counts_prefix, *args.shard)
+        # no longer finished, if an earlier run of this shard was
+        removeFile(csvfile+'.done')
+    # progress so far, the digests of every text written so far,
+    # and where the last complete run got to for --incremental
+    checkpoint_file = csvfile+".checkpoint"
+    dedup_journal = csvfile+".dedup"
+    state_file = csvfile+".state"
+    checkpoint = {
+        'dataset_id': dataset_id,
+        'compression': args.compress,
+        'input': args.input,
+        'shard': args.shard and list(args.shard),
+    }
+    if tool.count_columns is not None:
+        checkpoint['counts'] = counts_prefix
+    checkpoint.update(tool.settings())
+    # what a --shard run's output is only good to merge with
+    settings = dict(checkpoint)
+    if tool.count_columns is not None:
+        settings['counts'] = merged_counts
+    resume_from = None
+    if args.resume:
+        resume_from = loadCheckpoint(checkpoint_file)
+        if resume_from is None:
+            print('No checkpoint in',checkpoint_file,'- starting from the beginning')
+        elif any(resume_from.get(k) != checkpoint[k] for k in checkpoint):
+            sys.exit(checkpoint_file+' was made for another dataset, '
+                'pattern set or other settings, not resuming')
+
+    # carry on writing an existing output: (offset, rows, dedup journal bytes)
+    append_to = None
+    last_key = None
+    since = until = None
+    # how many superseded rows the output has already had dropped
+    if tool.dedup is not None:
+        checkpoint['compacted'] = 0
+    if resume_from is not None:
+        # json has no tuples
+        last_key = resume_from['last_key']
+        if isinstance(last_key, list):
+            last_key = tuple(last_key)
+        since, until = resume_from.get('since'), resume_from.get('until')
+        if tool.dedup is not None:
+            checkpoint['compacted'] = resume_from.get('compacted', 0)
+        append_to = (resume_from['offset'], resume_from['rows'], resume_from.get('dedup_bytes'))
+        print('Resuming after',tool.unit,last_key,'with',resume_from['rows'],'rows written')
+    elif args.incremental:
+        state = loadCheckpoint(state_file)
+        if state is None:
+            print('No previous run in',state_file,'- scanning the whole dataset')
+        elif any(state.get(k) != checkpoint[k] for k in checkpoint if k != 'compacted'):
+            print('Patterns or settings changed since the last run, rescanning the whole dataset')
+        else:
+            since = state['high_water']
+            if tool.dedup is not None:
+                checkpoint['compacted'] = state['compacted']
+            append_to = (state['offset'], state['rows'], state.get('dedup_bytes'))
+    if args.incremental and resume_from is None:
+        until = tool.high_water_mark(session, dataset_id)
+        print('Scanning',tool.unit+'s','with text_id above',since,'up to',until)
+    checkpoint['since'] = since
+    checkpoint['until'] = until
+
+    writer = MatchWriter(csvfile, tool.header(settings), compression=args.compress,
+                resume=append_to and append_to[:2])
+    # the deduper keeps digests of every text in the dataset written so far
+    # (a shard only has some of the dataset, --merge drops its duplicates)
+    deduper = None
+    if tool.dedup is not None and args.shard is None:
+        deduper = TextDeduper(args.dedup_memory*1024*1024, args.dedup_spill,
+                    journal=dedup_journal, journal_bytes=append_to and append_to[2])
+    counter = None
+    if counts_prefix is not None:
+        columns, categories = tool.count_columns()
+        counter = CountWriter(counts_prefix, tool.key_header, columns, categories,
+                    resume=resume_from and resume_from['count_state'])
+    sys.stdout.flush()
+
+    # fetch -> match -> parents -> write, each stage in its own thread,
+    # so the next batch is being fetched while this one is matched and written
+    if args.input is None:
+        # the reader stage gets its own session, sessions aren't thread-safe
+        fetch_session = tool.create_session(eng)
+        source = tool.fetch(fetch_session, dataset_id, last_key, since, until, args.shard)
+        fetch_parents = functools.partial(tool.fetch_parents, session=session,
+                            dataset_id=dataset_id)
+    else:
+        # parents can come before or after their replies in the file,
+        # so every text goes into an on-disk index first
+        print('Indexing texts in',args.input)
+        sys.stdout.flush()
+        parent_index = tool.index_file(args.input, getattr(args, 'dedup_spill', None))
+        print(parent_index.size,'texts indexed')
+        source = tool.fetch_file(args.input, last_key)
+        fetch_parents = functools.partial(tool.fetch_indexed, index=parent_index)
+    pipeline = Pipeline()
+    pipeline.addSource('fetch', countFetched(source, length_counts, tool.in_range))
+    pipeline.addStage('match',
+        functools.partial(tool.match, pool=pool, workers=args.workers))
+    pipeline.addStage('parents', functools.partial(resolveParents,
+        add_parents=tool.add_parents, fetch=fetch_parents, cache=parent_cache,
+        dedup=tool.dedup, deduper=deduper))
+    pipeline.addStage('write', functools.partial(writeBatches, tool=tool, writer=writer,
+        checkpoint_file=checkpoint_file, checkpoint=checkpoint,
+        batch_size=args.batch_size, counter=counter))
+    pipeline.run()
+    pipeline.printTimings()
+    # startup (connecting, tables, patterns) plus fetching the first batch
+    first_batch = pipeline.firstItemTime('fetch', started)
+    if first_batch is not None:
+        print('Time to first batch: {:.2f}s'.format(first_batch))
+    writer.close()
+    print('Wrote',writer.rows,'rows to',writer.path)
+    if counter is not None:
+        counter.close()
+        print('Wrote counts of',len(counter.columns),'patterns in',counter.rows,
+            tool.unit+'s to',counts_prefix+'.npz')
+    print('Parent text cache:',parent_cache.hits,'hits,',
+        parent_cache.misses,'misses,',len(parent_cache),'entries')
+    if tool.report_lengths is not None:
+        tool.report_lengths(session, dataset_id, length_counts, last_key, since, until,
+            args.shard)
+
+    # parentless copies of texts that later turned up with a parent
+    # (only if there are new ones since the file was last cleaned up)
+    rows = writer.rows
+    if deduper is not None:
+        if len(deduper.superseded) > checkpoint['compacted']:
+            text_column, parent_column = tool.dedup_columns
+            dropped = dropSuperseded(writer.path, deduper.superseded, text_column, parent_column)
+            rows -= dropped
+            print('Dropped',dropped,'rows superseded by a copy with a parent')
+        print('Duplicate texts:',deduper.stats())
+        dedup_bytes = deduper.commitJournal()
+        deduper.close()
+    # finished, nothing left to resume
+    # an incremental run leaves the dedup journal for the next one
+    if args.incremental:
+        state = dict(checkpoint)
+        state.update({
+            'high_water': until,
+            'offset': os.path.getsize(writer.path),
+            'rows': rows,
+        })
+        if deduper is not None:
+            state.update({
+                'compacted': len(deduper.superseded),
+                'dedup_bytes': dedup_bytes,
+            })
+        saveCheckpoint(state_file, state)
+    else:
+        removeFile(dedup_journal)
+        removeFile(state_file)
+    removeFile(checkpoint_file)
+    if args.shard is not None:
+        saveCheckpoint(csvfile+'.done', {
+            'settings': settings,
+            'path': writer.path,
+            'rows': rows,
+            'counts': counts_prefix and [counts_prefix, merged_counts],
+        })
+
+    if args.input is None:
+        fetch_session.close()
+        session.close()
+    else:
+        parent_index.close()
+    if args.stats:
+        stats_file = datasetPath(args.stats, dataset_id) if several else args.stats
+        extra = {}
+        if several:
+            # peak RSS is a high-water mark for a whole process, and the
+            # datasets share this one and the worker pool: the figures
+            # cover every dataset run so far, and with --parallel
+            # those running alongside this one
+            extra['peak_rss_scope'] = 'process'
+            extra['datasets_in_process'] = args.dataset
+            extra['parallel'] = args.parallel
+        saveStats(stats_file, tool.name, started, pipeline, writer,
+            time_to_first_batch=first_batch, dataset_id=dataset_id,
+            fetched=length_counts['fetched'], counts=counter and counter.stats(), **extra)
+
+# runDataset() for every dataset in args.dataset, up to --parallel at a time,
+# all sharing the one engine and worker pool
+# parallel: False to run them one at a time anyway (--profile)
+def runDatasets(tool, args, eng, pool, started, parallel=True):
+    several = len(args.dataset) > 1
+    # a single dataset's timings include the startup before this, as they always have
+    run = functools.partial(runDataset, tool=tool, args=args, eng=eng, pool=pool,
+                several=several, started=None if several else started)
+    if args.parallel > 1 and several and parallel:
+        with concurrent.futures.ThreadPoolExecutor(args.parallel) as datasets:
+            list(datasets.map(run, args.dataset))
+    else:
+        for dataset_id in args.dataset:
+            run(dataset_id)
+
+# --merge: the outputs of every --shard run of a dataset put together into
+# the file a single run would have written, with duplicate texts dropped
+# the same way for a tool that drops them (shards are merged in key order,
+# so the same copy comes first)
+def mergeShards(dataset_id, tool, args):
+    csvfile = tool.output_file(dataset_id)
+    try:
+        done = finishedShards(csvfile, args.merge)
+    except ValueError as e:
+        sys.exit(str(e))
+    settings = done[0]['settings']
+    print('Merging',args.merge,'shards into',csvfile)
+    sys.stdout.flush()
+    writer = MatchWriter(csvfile, tool.header(settings), compression=settings['compression'])
+    deduper = None
+    if tool.dedup is not None:
+        deduper = TextDeduper(args.dedup_memory*1024*1024, args.dedup_spill)
+        text_column, parent_column = tool.dedup_columns
+    for key, rows in mergeSortedRows([state['path'] for state in done], tool.csv_key):
+        # all rows of a post have the same text and parent
+        if deduper is None or deduper.check(rows[0][text_column],
+                rows[0][parent_column] != 'None'):
+            writer.writeRows(rows)
+    writer.close()
+    if deduper is None:
+        print('Wrote',writer.rows,'rows to',writer.path)
+    else:
+        dropped = dropSuperseded(writer.path, deduper.superseded, text_column, parent_column)
+        print('Wrote',writer.rows-dropped,'rows to',writer.path)
+        print('Dropped',dropped,'rows superseded by a copy with a parent')
+        print('Duplicate texts:',deduper.stats())
+        deduper.close()
+    if done[0]['counts'] is not None:
+        prefix = done[0]['counts'][1]
+        rows = mergeCounts([state['counts'][0] for state in done], prefix)
+        print('Wrote counts of',rows,tool.unit+'s to',prefix+'.npz')
@@ -11,23 +11,56 @@
 #   posts are only unique to the discussion
 
 import sqlalchemy as s
-import oursql
+# the MySQL driver, not needed for a sqlite:// url (see benchmark.py)
+try:
+    import oursql
+except ImportError:
+    oursql = None
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.dialects import mysql
-from sqlalchemy import func
+from sqlalchemy import func, event
 import sys
+import time
 import re
 import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from matchUtils import PatternRegistry, Lexicon, TextView, firstFindall
+from matchUtils import PatternProfiler
+from matchUtils import orderedPoolMap, workerContext
+from matchUtils import compressors
+from matchUtils import hashPatterns, hashPatternFiles, loadPickleCache, savePickleCache
+from matchUtils import datasetIds, shardSpec
+from matchUtils import BatchCounts, sparse
+from matchUtils import missing, chunks
+from matchUtils import MatchTool, runDatasets, mergeShards
+from matchUtils import readRecords, intOrNone, TextIndex
 
 ###########
 # Globals #
 ###########
 
-# set this in main()
-dataset_id = None
-# how many posts to get at once
+# how many posts to go through between checkpoints, set in main()
 batch_size = 100
+# how many posts go down the pipeline together, fetched in one round trip
+# (or batch_size if that's smaller)
+# each stage holds a few chunks at a time, so memory use doesn't grow
+# with batch_size
+chunk_size = 500
+# only posts with this many words are matched, set in main()
+min_words = 10
+max_words = 150
+# how many parent texts to keep around between batches
+parent_cache_size = 100000
+# how many parent posts to ask for in one query
+parent_chunk_size = 1000
+# every pattern in regex_dict, compiled once in main()
+# after the regex files have been loaded
+registry = None
+# a PatternProfiler when running with --profile, set in main()
+profiler = None
+# whether every pattern is also counted, for --counts, set in main()
+counting = False
 
 # files with regex patterns on each line to look for
 # by default, will search entire text for each pattern
@@ -39,21 +72,26 @@ batch_size = 100
 # Match Class #
 ###############
 
-# each match object, to be written to database
-class Match:
-    def __init__(self, 
-        disc_id=None, 
-        post_id=None, 
-        str_match=None, 
-        text=None, 
-        parent_id=None,
-        parent_text=None):
+# every match in one post, written out as one csv row per match string
+# the text and parent text are held once for the post, not once per match
+class PostMatches:
+    __slots__ = ('disc_id', 'post_id', 'str_matches', 'text',
+                 'parent_id', 'parent_text')
+
+    def __init__(self, disc_id, post_id, str_matches, text, parent_id):
         self.disc_id = disc_id
         self.post_id = post_id
-        self.str_match = str_match
+        self.str_matches = str_matches
         self.text = text
         self.parent_id = parent_id
-        self.parent_text = parent_text
+        # this gets added later, so don't have it in constructor
+        self.parent_text = None
+
+    # the csv rows for this post
+    def rows(self):
+        parent_id, parent_text = str(self.parent_id), str(self.parent_text)
+        return [[self.disc_id, self.post_id, str_match, self.text, parent_id, parent_text]
+                for str_match in self.str_matches]
 
 #############################
 # Database connection/setup #
@@ -61,13 +99,35 @@ class Match:
 
 # open connection to database
 # then return engine object
-def connect(username, password, database):
-    db_uri = 'mysql+oursql://{}:{}@{}'.format(username, password, database)
+# database is server/database, or a whole url such as sqlite:///bench.db
+# (then username and password aren't used)
+# pool_size: connections kept open, each dataset being run uses two
+def connect(username, password, database, pool_size=5):
+    if '://' in database:
+        db_uri = database
+    else:
+        db_uri = 'mysql+oursql://{}:{}@{}'.format(username, password, database)
     # db_uri = 'mysql://{}:{}@{}'.format(username, password, database)
-    engine = s.create_engine(db_uri, encoding='utf-8')
+    connect_args = {}
+    # a session is handed from pipeline stage to pipeline stage,
+    # but only ever used by one thread at a time
+    engine_args = {}
+    if db_uri.startswith('sqlite'):
+        connect_args['check_same_thread'] = False
+    else:
+        engine_args['pool_size'] = pool_size
+    engine = s.create_engine(db_uri, encoding='utf-8', connect_args=connect_args,
+                **engine_args)
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', addSqliteFunctions)
     engine.connect()
     return engine
 
+# sqlite has no CHAR_LENGTH, which the word count filter needs
+def addSqliteFunctions(dbapi_connection, connection_record):
+    dbapi_connection.create_function('char_length', 1,
+        lambda text: None if text is None else len(text))
+
 # create a session from the engine
 def createSession(eng):
     Session = s.orm.sessionmaker()
@@ -75,50 +135,53 @@ def createSession(eng):
     session = Session()
     return session
 
-# creates a table class for each table used
-def generateTableClasses(eng):
-    ABase = automap_base()
-    ABase.prepare(eng, reflect=True)
+# reflect just the tables used, not the whole database
+# schema_cache: pickle file keeping the reflected tables between runs,
+# made again if it was for another database or set of tables
+def reflectTables(eng, names, schema_cache=None):
+    key = [repr(eng.url), sorted(names)]
+    metadata = loadPickleCache(schema_cache, key)
+    if metadata is not None:
+        print('Using the table definitions cached in',schema_cache)
+        return metadata
+    metadata = s.MetaData()
+    metadata.reflect(eng, only=names)
+    if schema_cache is not None:
+        savePickleCache(schema_cache, key, metadata)
+    return metadata
+
+# the columns of each table used, e.g. Post.text_id
+def generateTableClasses(eng, schema_cache=None):
+    start = time.perf_counter()
+    metadata = reflectTables(eng, ['posts', 'texts'], schema_cache)
     global Post, Text
-    Post = ABase.classes.posts
-    Text = ABase.classes.texts
+    Post = metadata.tables['posts'].c
+    Text = metadata.tables['texts'].c
+    print('Tables ready in {:.2f}s'.format(time.perf_counter()-start))
 
 ###################
 # Regex matching  #
 ###################
 
 # match_regex appears as the first phrase/word in text
-def startOfPostMatch(text, match_regex):
-    start_match = r"^"+match_regex
-    matches = re.findall(start_match, text)
-    if len(matches)>0:
-        return matches[0]
-    return None
+# (the registry already compiled it with a leading ^)
+def startOfPostMatch(view, match_regex):
+    return firstFindall(match_regex, view.text)
     
 # match_regex appears in the first sentence
 # minus the punctuation - use startOfPostMatch if you want that
-def firstSentenceMatch(text, match_regex):
-    modtext = text.replace('?','.')
-    modtext = modtext.replace('!','.')
-    first_sentence = modtext.split('.')[0]
-    matches = re.findall(match_regex, first_sentence)
-    if len(matches)>0:
-        return matches[0]
-    return None
+def firstSentenceMatch(view, match_regex):
+    return firstFindall(match_regex, view.first_sentence)
 
 # match_regex appears anywhere in the text
-def anywhereMatch(text, match_regex):
-    matches = re.findall(match_regex, text)
-    if len(matches)>0:
-        return matches[0]
-    return None
+def anywhereMatch(view, match_regex):
+    return firstFindall(match_regex, view.text)
 
 # match_regex appears in the first X words of the text
-def firstXWordsMatch(text, match_regex, numWords=10):
-    splitText = text.split(' ')
-    firstXWords = ' '.join(splitText[:numWords])
-    if match_regex in firstXWords:
-        return match_regex
+# (checked as a plain substring of the pattern source)
+def firstXWordsMatch(view, match_regex, numWords=10):
+    if match_regex.pattern in view.firstWords(numWords):
+        return match_regex.pattern
     else:
         return None
 
@@ -156,20 +219,106 @@ match_functions={
     'D':    firstXWordsMatch,
 }
 
-# find files with regex patterns to use
+# the same places looked in, counting every occurrence instead (--counts)
+def startOfPostCount(view, match_regex):
+    return len(match_regex.findall(view.text))
+
+def firstSentenceCount(view, match_regex):
+    return len(match_regex.findall(view.first_sentence))
+
+def anywhereCount(view, match_regex):
+    return len(match_regex.findall(view.text))
+
+def firstXWordsCount(view, match_regex, numWords=10):
+    return view.firstWords(numWords).count(match_regex.pattern)
+
+count_functions={
+    'A':    startOfPostCount,
+    'B':    firstSentenceCount,
+    'C':    anywhereCount,
+    'D':    firstXWordsCount,
+}
+
+# find files with regex patterns to use, in name order
+# (the order decides lexicon entry ids, patternHash() and the --counts
+# columns, so it has to be the same on every host running a --shard)
 def findRegexFiles(dir):
     regex_files = []
-    for file in os.listdir(dir):
+    for file in sorted(os.listdir(dir)):
         regex_files.append(dir+'/'+file)
     return regex_files
 
-# loads regex patterns from LIWC regex files
+# compile everything in regex_dict once
+def buildRegistry():
+    global registry
+    registry = PatternRegistry(regex_dict)
+
+# changes whenever regex_dict or the lexicon files do,
+# checkpoints are only good for the patterns they were made with
+def patternHash():
+    return hashPatterns(regex_dict, lexicon.entries, lexicon.categories)
+
+# runs in each worker process of --workers mode
+# the compiled patterns are shipped over once here instead of with every batch
+def initWorker(worker_registry, worker_lexicon, word_range, profile, count=False):
+    global registry, lexicon, min_words, max_words, profiler, counting
+    registry = worker_registry
+    lexicon = worker_lexicon
+    min_words, max_words = word_range
+    counting = count
+    if profile:
+        profiler = PatternProfiler()
+
+# LIWC word lists, matched token by token (see matchUtils.Lexicon)
+# the match reported is the token itself
+lexicon = Lexicon()
+
+# loads LIWC lexicon files
+# plain words and word* prefixes go into the lexicon,
+# anything else (e.g. phrases) falls back to a "C" regex
 def addRegexFromFile(filename):
-    with open(filename,'r') as f:
-        for line in f:
-            r = line.rstrip()
-            r = r.replace("*",".*")
-            regex_dict["C "+r] = '\W('+r+')\W' 
+    category = os.path.splitext(os.path.basename(filename))[0]
+    for r in lexicon.addFile(filename):
+        r = r.replace("*",".*")
+        regex_dict["C "+r] = r'\W('+r+r')\W'
+        pattern_categories.setdefault("C "+r, []).append(category)
+
+# the lexicon files each of those "C" regexes came from, for --counts
+pattern_categories = {}
+
+# fill in regex_dict, the lexicon and the registry from the lexicon files
+# pattern_cache: pickle file keeping them between runs, built again
+# whenever a lexicon file or the built-in patterns change
+def loadPatterns(lexicon_dir, pattern_cache=None):
+    global regex_dict, lexicon, registry, pattern_categories
+    start = time.perf_counter()
+    regex_files = findRegexFiles(lexicon_dir)
+    key = hashPatternFiles(regex_files, regex_dict)
+    cached = loadPickleCache(pattern_cache, key)
+    if cached is not None:
+        print('Using the patterns cached in',pattern_cache)
+        regex_dict, lexicon, registry, pattern_categories = cached
+    else:
+        for f in regex_files:
+            addRegexFromFile(f)
+        buildRegistry()
+        if pattern_cache is not None:
+            savePickleCache(pattern_cache, key,
+                (regex_dict, lexicon, registry, pattern_categories))
+    registry.reportErrors()
+    printPatternSummary()
+    print('Patterns ready in {:.2f}s'.format(time.perf_counter()-start))
+
+# how many patterns of each position class and lexicon entries there are
+# (regex_dict itself runs to thousands of lines with the LIWC files loaded)
+def printPatternSummary():
+    positions = {}
+    for entry in registry.entries:
+        positions[entry.position] = positions.get(entry.position, 0)+1
+    print(len(registry),'patterns:',
+        ', '.join('{} {}'.format(positions[p], p) for p in sorted(positions)))
+    categories = set(c for cs in lexicon.categories for c in cs)
+    print(len(lexicon),'lexicon entries in',len(categories),'categories')
 
 #################################
 # General DB-querying functions #
@@ -182,25 +331,126 @@ def cleanText(text):
         newtext = newtext.replace('"',"'")
         return newtext
 
-# query the db once per batch, then get matches
-def getBatchMatches(post_id, session):
-    pquery = session.query(Post,Text).\
-                filter((Post.dataset_id==dataset_id) &
-                        (Text.dataset_id==dataset_id) & 
-                        (Post.text_id==Text.text_id)).\
-                limit(batch_size).offset(post_id)
+# len(cleanText(text).split(' ')) without lowercasing or splitting,
+# cleanText only turns newlines into spaces
+def wordCount(text):
+    return text.count(' ')+text.count('\n')+1
+
+def inWordRange(text):
+    return bool(text) and min_words <= wordCount(text) <= max_words
+
+# the same count done by the database, so posts that are too short or
+# too long mostly never leave it (the exact check above still runs on
+# everything fetched, this only has to never reject a post it would keep)
+def sqlWordCount(column):
+    separators = func.char_length(column) - \
+        func.char_length(func.replace(func.replace(column,' ',''),'\n',''))
+    return separators+1
+
+# where clause picking the posts of the dataset after last_key,
+# joined to their texts
+# since/until: only posts with since < text_id <= until, for --incremental
+# shard: (i, N), only the discussions with discussion_id % N == i-1, for --shard
+def postFilter(dataset_id, last_key=None, since=None, until=None, shard=None):
+    conditions = [Post.dataset_id==dataset_id,
+                  Text.dataset_id==dataset_id,
+                  Post.text_id==Text.text_id]
+    if shard is not None:
+        conditions.append(Post.discussion_id % shard[1] == shard[0]-1)
+    if since is not None:
+        conditions.append(Post.text_id > since)
+    if until is not None:
+        conditions.append(Post.text_id <= until)
+    if last_key is not None:
+        last_disc_id, last_post_id = last_key
+        conditions.append(
+                    (Post.discussion_id > last_disc_id) |
+                    ((Post.discussion_id == last_disc_id) &
+                        (Post.post_id > last_post_id)))
+    return s.and_(*conditions)
+
+# go through the dataset one chunk at a time, in (discussion_id, post_id) order
+# one plain select of just the columns needed per chunk, seeking past the
+# last key of the chunk before (keyset paging, never an OFFSET), so every
+# chunk costs about the same and no ORM objects are built
+# each chunk is read to the end straight away, so the server isn't left
+# holding an open result set while the pipeline is busy further down
+# (MySQL gives up on those after net_write_timeout)
+# last_key: start after this (discussion_id, post_id), for --resume
+def iterBatches(session, dataset_id, last_key=None, since=None, until=None, shard=None):
+    size = min(chunk_size, batch_size)
+    while True:
+        query = s.select([Post.discussion_id, Post.post_id, Text.text, Post.parent_post_id]).\
+                    where(postFilter(dataset_id, last_key, since, until, shard)).\
+                    where(sqlWordCount(Text.text).between(min_words, max_words)).\
+                    order_by(Post.discussion_id, Post.post_id).\
+                    limit(size)
+        # plain tuples, so chunks can be shipped to worker processes
+        rows = [tuple(row) for row in session.execute(query)]
+        if rows:
+            yield rows
+        if len(rows) < size:
+            return
+        last_key = rows[-1][:2]
+
+# one post of an --input dump as an iterBatches row
+def fileRow(record):
+    return (int(record['discussion_id']), int(record['post_id']),
+            record['text'], intOrNone(record.get('parent_post_id')))
+
+# iterBatches for an --input dump, posts come in the order they are in the file
+# last_key: skip everything up to and including this post, for --resume
+def iterFileBatches(path, last_key=None):
+    batch = []
+    for record in readRecords(path):
+        row = fileRow(record)
+        if last_key is not None:
+            if row[:2] == last_key:
+                last_key = None
+            continue
+        batch.append(row)
+        if len(batch) == min(chunk_size, batch_size):
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# every text in an --input dump, keyed like fetchParentTexts keys
+# (a first pass over the file, before the matching one)
+def indexPostFile(path, tmp_dir=None):
+    index = TextIndex(tmp_dir)
+    index.build(((row[1], row[0]), row[2])
+        for row in map(fileRow, readRecords(path)))
+    return index
+
+# how many posts the run would have fetched without the length filter
+def countPosts(session, dataset_id, last_key=None, since=None, until=None, shard=None):
+    query = s.select([func.count()]).where(
+                postFilter(dataset_id, last_key, since, until, shard))
+    return session.execute(query).scalar()
+
+# newest text_id in the dataset right now
+# texts get their ids in the order they are imported, so an incremental
+# run picks up everything above the previous run's mark
+def highWaterMark(session, dataset_id):
+    query = s.select([func.max(Post.text_id)]).where(Post.dataset_id==dataset_id)
+    return session.execute(query).scalar()
+
+# get matches from one batch of
+# (discussion_id, post_id, text, parent_post_id) rows
+# with --counts, also a BatchCounts with a row for every post checked
+def getBatchMatches(rows):
     matches = []
-    for p,t in pquery.all():
-        if t.text:
-            if len(cleanText(t.text).split(' ')) in range(10,151):
-                m = getMatchesFromText(
-                        p.discussion_id, 
-                        p.post_id, 
-                        t.text, 
-                        p.parent_post_id
-                        )
-                matches += m
-    return matches
+    counts = BatchCounts() if counting else None
+    for disc_id, post_id, text, parent_id in rows:
+        if inWordRange(text):
+            view = TextView(text, cleanText)
+            m = getMatchesFromText(disc_id, post_id, view, parent_id)
+            if m is not None:
+                matches.append(m)
+            if counts is not None:
+                counts.add((disc_id, post_id), countPatterns(view))
+    return matches, counts
 
 # def getBatchMatches(post_id, session):
 #     pquery = session.query(Post).\
@@ -214,130 +464,342 @@ def getBatchMatches(post_id, session):
 
 
 # check for each of the strings in the string_dict
-# if exists, create a Match object
-def getMatchesFromText(disc_id, post_id, text, parent_id):
-    newtext = cleanText(text)
+# if any match, return one PostMatches for the post (None otherwise)
+def getMatchesFromText(disc_id, post_id, view, parent_id):
+    if profiler is None:
+        r_matches = matchPatterns(view)
+    else:
+        r_matches = profilePatterns(view)
+    if not r_matches:
+        return None
+    return PostMatches(disc_id, post_id, tuple(r_matches), view.text, parent_id)
+
+# the match string of every pattern and lexicon entry found in a text
+def matchPatterns(view):
     r_matches = []
-    for r in regex_dict:
-        if r[0] in match_functions:
-            r_match = match_functions[r[0]](newtext, regex_dict[r])
+    anywhere = registry.anywhere.match(view.text)
+    for entry in registry.entries:
+        if entry.position == 'C':
+            if entry.key in anywhere:
+                r_matches.append(anywhere[entry.key])
+        elif entry.position in match_functions:
+            r_match = match_functions[entry.position](view, entry.compiled)
             if r_match != None:
                 r_matches.append(r_match)
-    matches = []
-    for r_match in r_matches:
-        m = Match(disc_id, post_id, r_match, newtext, parent_id)
-        matches.append(m)
-    return matches
-
-# get the parent's text from the parent_id in match objects
-def addParentText(matches, session):
-    disc_ids = set([m.disc_id for m in matches if m.parent_id is not None])
-    # get way more posts than we need, whittle down
-    pquery = session.query(Post).\
-                filter(Post.dataset_id==dataset_id).\
-                filter(Post.discussion_id.in_(disc_ids))
-    # now have a list of all posts from all discussions that might be relevant
-    pd_text_ids = {}
-    for p in pquery.all():
-        pd_text_ids[(p.post_id, p.discussion_id)] = p.text_id
-    # fish out relevant text_ids
-    relevant_text_ids = []
-    for m in matches:
-        if (m.parent_id, m.disc_id) in pd_text_ids:
-            relevant_text_ids.append(pd_text_ids[(m.parent_id,m.disc_id)])
-    # now actually get the texts
-    tquery = session.query(Text).\
-                filter(Text.dataset_id==dataset_id).\
-                filter(Text.text_id.in_(relevant_text_ids))
-    t_id_texts = {}
-    for t in tquery.all():
-        t_id_texts[t.text_id] = t.text
-    # link them up with their respective Match objects
+    found = lexicon.match(view.tokens)
+    for entry_id in sorted(found):
+        r_matches.append(found[entry_id])
+    return r_matches
+
+# how often every pattern and lexicon entry occurs in a text, for --counts
+# dict of column -> count, columns in countColumns() order
+def countPatterns(view):
+    counts = {}
+    anywhere = registry.anywhere.count(view.text)
+    for column, entry in enumerate(registry.entries):
+        if entry.position == 'C':
+            n = anywhere.get(entry.key, 0)
+        elif entry.position in count_functions:
+            n = count_functions[entry.position](view, entry.compiled)
+        else:
+            continue
+        if n:
+            counts[column] = n
+    for entry_id, n in lexicon.count(view.tokens).items():
+        counts[len(registry)+entry_id] = n
+    return counts
+
+# names and categories of the --counts columns: every compiled pattern,
+# then every lexicon entry, each in the lexicon files it came from
+# (the built-in patterns aren't in any category)
+def countColumns():
+    columns = [entry.key for entry in registry.entries]+lexicon.entries
+    categories = [pattern_categories.get(entry.key, []) for entry in registry.entries]+\
+        lexicon.categories
+    return columns, categories
+
+# matchPatterns() for --profile, timing every pattern on its own
+# (the lexicon is one trie walk, so it's timed as a whole)
+def profilePatterns(view):
+    r_matches = []
+    # clean the text first, so the first pattern isn't charged for it
+    view.text
+    anywhere = registry.anywhere.match(view.text, profiler)
+    for entry in registry.entries:
+        if entry.position == 'C':
+            if entry.key in anywhere:
+                r_matches.append(anywhere[entry.key])
+        elif entry.position in match_functions:
+            start = time.perf_counter()
+            r_match = match_functions[entry.position](view, entry.compiled)
+            profiler.record(entry.key, time.perf_counter()-start, r_match != None)
+            if r_match != None:
+                r_matches.append(r_match)
+    start = time.perf_counter()
+    found = lexicon.match(view.tokens)
+    profiler.record('(LIWC lexicon)', time.perf_counter()-start, bool(found))
+    for entry_id in sorted(found):
+        r_matches.append(found[entry_id])
+    return r_matches
+
+# one join on exactly the (parent_post_id, discussion_id) pairs given,
+# returns a dict of pair -> cleaned parent text
+def fetchParentTexts(keys, session, dataset_id):
+    texts = {}
+    for chunk in chunks(keys, parent_chunk_size):
+        pquery = s.select([Post.post_id, Post.discussion_id, Text.text]).\
+                    where((Post.dataset_id==dataset_id) &
+                            (Text.dataset_id==dataset_id) &
+                            (Post.text_id==Text.text_id)).\
+                    where(s.tuple_(Post.post_id, Post.discussion_id).in_(chunk))
+        for post_id, disc_id, text in session.execute(pquery):
+            texts[(post_id, disc_id)] = cleanText(text)
+    return texts
+
+# the same from the --input dump's index of texts
+def fetchIndexedTexts(keys, index):
+    texts = index.fetch(keys)
+    for key in texts:
+        texts[key] = cleanText(texts[key])
+    return texts
+
+# get the parent's text from the parent_id in PostMatches objects
+# parents not already in the cache are fetched in one go
+# fetch: fetchParentTexts or fetchIndexedTexts with its session/index filled in
+# cache: the dataset's LRUCache of parent texts, see runDataset()
+def addParentText(matches, fetch, cache):
+    keys = set([(m.parent_id, m.disc_id) for m in matches if m.parent_id is not None])
+    ptexts = {}
+    to_fetch = []
+    for key in keys:
+        ptext = cache.get(key)
+        if ptext is missing:
+            to_fetch.append(key)
+        else:
+            ptexts[key] = ptext
+    if to_fetch:
+        fetched = fetch(to_fetch)
+        for key in to_fetch:
+            # parents that aren't in the db get cached as None too
+            ptexts[key] = fetched.get(key)
+            cache.put(key, ptexts[key])
+    # link them up with their respective PostMatches
     for m in matches:
-        if (m.parent_id, m.disc_id) in pd_text_ids:
-            ptext = t_id_texts[pd_text_ids[(m.parent_id, m.disc_id)]]
-            m.parent_text = cleanText(ptext)
+        if ptexts.get((m.parent_id, m.disc_id)) is not None:
+            m.parent_text = ptexts[(m.parent_id, m.disc_id)]
     return matches
 
 # some posts are duplicated, IE posts with different post_id and discussion_id
 # have the same exact text
-# let's remove the ones that don't have parent texts,
-# if both do or don't, just pick one to remove
-def removeDuplicateTexts(matches):
-    matches = sorted(matches, key=lambda k:k.text)
-    origLen = len(matches)
-    for i in range(origLen-1):
-        while i < len(matches)-1:
-            if matches[i].text == matches[i+1].text:
-                if matches[i].parent_id == None:
-                    del matches[i]
-                else:
-                    del matches[i+1]
-            else:
-                break
-    return matches
+# keep the first copy of each text in the dataset; if a later copy has a
+# parent and the kept one doesn't, keep the later one as well and drop the
+# parentless one from the csv at the end of the run
+# all matches of a post are kept or dropped together
+# deduper: the dataset's TextDeduper, holding digests of every text written so far
+def removeDuplicateTexts(matches, deduper):
+    return [m for m in matches if deduper.check(m.text, m.parent_id is not None)]
 
 
-# given list of match objects, writes to csv
-def writeMatchesToCSV(matches, csvfile):
-    with open(csvfile,'a', encoding='utf-8') as f:
-        for m in matches:
-            f.write('"'+str(m.disc_id)+'",')
-            f.write('"'+str(m.post_id)+'",')
-            f.write('"'+m.str_match+'",')
-            f.write('"'+m.text+'",')
-            f.write('"'+str(m.parent_id)+'",')
-            f.write('"'+str(m.parent_text)+'"')
-            f.write('\n')
-    
+###################
+# Pipeline stages #
+###################
+
+# each stage takes an iterator of chunks of rows and yields them on to the next
+
+# (rows, matches, counts) for each batch, matched here or in a process pool
+# counts is None unless running with --counts
+def matchBatches(batches, pool=None, workers=1):
+    if pool is None:
+        for rows in batches:
+            matches, counts = getBatchMatches(rows)
+            yield rows, matches, counts
+    elif profiler is None:
+        for rows, (matches, counts) in orderedPoolMap(pool, getBatchMatches,
+                batches, 2*workers):
+            yield rows, matches, counts
+    else:
+        # workers send back what they profiled along with each batch
+        for rows, ((matches, counts), stats) in orderedPoolMap(pool, profileBatchMatches,
+                batches, 2*workers):
+            profiler.merge(stats)
+            yield rows, matches, counts
+
+# getBatchMatches() in a worker process with --profile
+def profileBatchMatches(rows):
+    return getBatchMatches(rows), profiler.take()
+
+# what the length filter in the query saved, and what got through it
+# only to be rejected here (should be nothing)
+# without a session (--input) everything was read and checked here
+def printLengthCounts(session, dataset_id, length_counts, last_key, since, until, shard):
+    fetched, rejected = length_counts['fetched'], length_counts['rejected']
+    if session is None:
+        print('Posts outside',min_words,'to',max_words,'words:',rejected,
+            'skipped;',fetched-rejected,'posts checked for matches')
+        return
+    total = countPosts(session, dataset_id, last_key, since, until, shard)
+    print('Posts outside',min_words,'to',max_words,'words:',
+        total-fetched,'left in the database,',rejected,'fetched and skipped;',
+        fetched-rejected,'posts checked for matches')
+
+# what file a dataset's matches go to
+def outputFile(dataset_id):
+    return "matches_regex_dataset_"+str(dataset_id)+".csv"
+
+header = ['discussion_id','post_id','string matched','post text','parent_post_id','parent text']
+
+# what the shared runDataset() and mergeShards() in matchUtils need from us
+# (after main() has set the globals)
+def matchTool():
+    return MatchTool('regexMatchTool', 'post',
+        output_file=outputFile,
+        header=lambda settings: header,
+        key=lambda row: row[:2],
+        csv_key=lambda row: (int(row[0]), int(row[1])),
+        settings=lambda: {'pattern_hash': patternHash(), 'word_range': [min_words, max_words]},
+        create_session=createSession,
+        fetch=iterBatches,
+        fetch_file=iterFileBatches,
+        index_file=indexPostFile,
+        high_water_mark=highWaterMark,
+        fetch_parents=fetchParentTexts,
+        fetch_indexed=fetchIndexedTexts,
+        match=matchBatches,
+        add_parents=addParentText,
+        in_range=lambda row: inWordRange(row[2]),
+        report_lengths=printLengthCounts,
+        dedup=removeDuplicateTexts,
+        dedup_columns=(3, 4),
+        key_header=['discussion_id','post_id'],
+        count_columns=countColumns)
 
 ##################
 # Main Execution #
 ##################
 
-def main(user=sys.argv[1],pword=sys.argv[2],db=sys.argv[3],dataset=sys.argv[4]):
-
-    # usual stuff to sync with MySQL db, setup
-    print('Connecting to database',db,'as user',user)
-    sys.stdout.flush()
-    eng = connect(user, pword, db)
-    metadata = s.MetaData(bind=eng)
-    session = createSession(eng)
-    generateTableClasses(eng)
-    global dataset_id
-    dataset_id = int(dataset)
-    matches = []
-    
-    regex_files = findRegexFiles('LIWC_lexicons')
-
-    for f in regex_files:
-        addRegexFromFile(f)
-    print (regex_dict)
-    
-    # what file to write to
-    csvfile = "matches_regex_dataset_"+dataset+".csv"
-    with open(csvfile,'w',encoding='utf-8') as f:
-        f.write('"discussion_id","post_id","string matched","post text","parent_post_id"\n')
-    
-    # query db for # of posts
-    totalPosts = None
-    for ct in session.query(
-            func.count(Post.post_id)).\
-            filter(Post.dataset_id.like(dataset_id)):
-        totalPosts = ct[0]
-        print('total number of posts in dataset:',totalPosts)
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Find regex/LIWC matches in every post of a dataset.')
+    parser.add_argument('user', nargs='?')
+    parser.add_argument('pword', nargs='?')
+    parser.add_argument('db', nargs='?',
+        help='server/database, or a url like sqlite:///bench.db')
+    parser.add_argument('dataset', type=datasetIds,
+        help='dataset id, or several as a list/range like 1-5,9')
+    parser.add_argument('--input', metavar='FILE',
+        help='read posts from a JSONL or CSV dump (.gz/.bz2/.xz too) '
+            'instead of the database; only the dataset argument is needed')
+    parser.add_argument('--compress', choices=sorted(compressors),
+        help='write the csv compressed with gzip, bzip2 or xz')
+    parser.add_argument('--resume', action='store_true',
+        help='carry on from the checkpoint an interrupted run left behind')
+    parser.add_argument('--incremental', action='store_true',
+        help='only match posts added since the last --incremental run, '
+            'appending to its output (everything is rescanned if the patterns changed)')
+    parser.add_argument('--shard', type=shardSpec, metavar='I/N',
+        help='only match the discussions in shard I of N (1 to N), into a file '
+            'of its own; run every shard, then put them together with --merge N')
+    parser.add_argument('--merge', type=int, metavar='N',
+        help='merge the outputs of a finished --shard I/N run, '
+            'no database is needed')
+    parser.add_argument('--batch-size', type=int, default=batch_size,
+        help='posts to go through between checkpoints (default %(default)s), '
+            'memory use doesn\'t depend on it')
+    parser.add_argument('--workers', type=int, default=1,
+        help='match batches in this many processes (default 1)')
+    parser.add_argument('--parallel', type=int, default=1,
+        help='run this many of the datasets at once (default 1), '
+            'sharing the connection pool, patterns and worker processes')
+    parser.add_argument('--dedup-memory', type=int, default=512,
+        help='MB of text digests kept in memory before spilling to disk (default 512)')
+    parser.add_argument('--dedup-spill', default=None,
+        help='directory for spilled digests (default: a temp dir)')
+    parser.add_argument('--parent-cache', type=int, default=parent_cache_size,
+        help='parent texts kept between batches (default %(default)s)')
+    parser.add_argument('--min-words', type=int, default=min_words,
+        help='skip posts with fewer words than this (default %(default)s)')
+    parser.add_argument('--max-words', type=int, default=max_words,
+        help='skip posts with more words than this (default %(default)s)')
+    parser.add_argument('--profile', metavar='FILE',
+        help='time every pattern and write calls, hits and seconds per pattern '
+            'to FILE, slowest first (json if FILE ends in .json, csv otherwise)')
+    parser.add_argument('--schema-cache', metavar='FILE',
+        help='keep the reflected table definitions in FILE, so later runs '
+            'don\'t have to ask the database for them')
+    parser.add_argument('--counts', metavar='PREFIX',
+        help='also count every occurrence of each pattern and lexicon entry '
+            'in every post checked, saved as a sparse matrix in PREFIX.npz with '
+            'per-category totals in PREFIX.categories.npz (needs numpy and scipy)')
+    parser.add_argument('--pattern-cache', metavar='FILE',
+        help='keep the loaded lexicons and compiled patterns in FILE, '
+            'so later runs only read them again if a lexicon file changed')
+    parser.add_argument('--stats', metavar='FILE',
+        help='write run time, stage timings and peak memory to FILE as json')
+    args = parser.parse_args(argv)
+    if args.input is None and args.db is None and args.merge is None:
+        parser.error('user, pword and db are needed unless reading an --input file')
+    if args.shard is not None and (args.input is not None or args.incremental):
+        parser.error('--shard needs the database and can\'t be used with --incremental')
+    if args.shard is not None and args.merge is not None:
+        parser.error('--merge puts the shards together after they have all been run')
+    if args.input is not None and args.incremental:
+        parser.error('--incremental needs the database, it can\'t be used with --input')
+    if args.input is not None and len(args.dataset) > 1:
+        parser.error('an --input file holds one dataset')
+    if args.counts is not None and args.incremental:
+        parser.error('--counts can\'t be used with --incremental, '
+            'the matrices are only written for a whole run')
+    if args.counts is not None and sparse is None:
+        parser.error('--counts needs numpy and scipy')
+    return args
+
+def main(args=None):
+    if args is None:
+        args = parseArgs()
+    started = time.perf_counter()
+    user, pword, db = args.user, args.pword, args.db
+    if args.merge is not None:
+        for dataset_id in args.dataset:
+            mergeShards(dataset_id, matchTool(), args)
+        return
+
+    # one engine, one set of tables, one compiled pattern set
+    # and one worker pool for every dataset
+    eng = None
+    if args.input is None:
+        # usual stuff to sync with MySQL db, setup
+        print('Connecting to database',db,'as user',user)
         sys.stdout.flush()
-
-    for post_id in range(totalPosts):
-        if post_id%batch_size == 0:
-            matches = getBatchMatches(post_id, session)
-            matches = removeDuplicateTexts(matches)
-            matches = addParentText(matches, session)
-            print('Writing matches from post',post_id+1,'to',post_id+batch_size)
-            sys.stdout.flush()
-            writeMatchesToCSV(matches, csvfile)
-
-    session.close()
+        eng = connect(user, pword, db, pool_size=max(5, 2*args.parallel))
+        generateTableClasses(eng, args.schema_cache)
+    global min_words, max_words, profiler, counting, batch_size
+    min_words, max_words = args.min_words, args.max_words
+    batch_size = args.batch_size
+    if args.profile:
+        profiler = PatternProfiler()
+    counting = args.counts is not None
+
+    loadPatterns('LIWC_lexicons', args.pattern_cache)
+
+    # matching can run in a process pool, batches still come out in order
+    pool = None
+    if args.workers > 1:
+        pool = ProcessPoolExecutor(args.workers, mp_context=workerContext(),
+                    initializer=initWorker, initargs=(registry, lexicon, (min_words, max_words),
+                    args.profile is not None, counting))
+    # --profile runs them one at a time, so no pattern is timed
+    # while another dataset's matching competes with it
+    runDatasets(matchTool(), args, eng, pool, started, parallel=profiler is None)
+    if pool is not None:
+        pool.shutdown()
+    if len(args.dataset) > 1:
+        print('Ran',len(args.dataset),'datasets in {:.2f}s'.format(time.perf_counter()-started))
+    if profiler is not None:
+        rows = profiler.save(args.profile, regex_dict)
+        print('Wrote pattern profile to',args.profile)
+        for row in rows[:10]:
+            print('  {:>9.3f}s {:>9} calls {:>7} hits  {}'.format(
+                row['seconds'], row['calls'], row['hits'], row['key']))
 
 if __name__ == "__main__":
     main()
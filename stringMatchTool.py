@@ -11,48 +11,93 @@
 #   posts are only unique to the discussion
 
 import sqlalchemy as s
-import oursql
+# the MySQL driver, not needed for a sqlite:// url (see benchmark.py)
+try:
+    import oursql
+except ImportError:
+    oursql = None
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.ext.automap import automap_base
 from sqlalchemy.dialects import mysql
 from sqlalchemy import func
 import sys
+import time
 import re
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from matchUtils import AhoCorasick, TextView, orderedPoolMap, workerContext
+from matchUtils import compressors
+from matchUtils import hashPatterns, loadPickleCache, savePickleCache
+from matchUtils import datasetIds, shardSpec
+from matchUtils import missing, chunks
+from matchUtils import MatchTool, runDatasets, mergeShards
+from matchUtils import readRecords, intOrNone, TextIndex
 
 ###########
 # Globals #
 ###########
 
-# set this in main()
-dataset_id = None
-# how many posts to get at once
+# how many posts to go through between checkpoints, set in main()
 batch_size = 10000
+# how many posts go down the pipeline together, fetched in one round trip
+# (or batch_size if that's smaller)
+# each stage holds a few chunks at a time, so memory use doesn't grow
+# with batch_size
+chunk_size = 500
+# how many parent texts to keep around between batches
+parent_cache_size = 100000
+# how many parent posts to ask for in one query
+parent_chunk_size = 1000
 
 ###############
 # Match Class #
 ###############
 
-# each match object, to be written to database
-class Match:
-    def __init__(self, disc_id, post_id, str_match, text, parent_id):
+# every match in one post, written out as one csv row per match string
+# the text and parent text are held once for the post, not once per match
+class PostMatches:
+    __slots__ = ('disc_id', 'post_id', 'str_matches', 'text',
+                 'parent_id', 'parent_text')
+
+    def __init__(self, disc_id, post_id, str_matches, text, parent_id):
         self.disc_id = disc_id
         self.post_id = post_id
-        self.str_match = str_match
+        self.str_matches = str_matches
         self.text = text
         self.parent_id = parent_id
         # this gets added later, so don't have it in constructor
         self.parent_text = None
 
+    # the csv rows for this post
+    def rows(self):
+        parent_id, parent_text = str(self.parent_id), str(self.parent_text)
+        return [[self.disc_id, self.post_id, str_match, self.text, parent_id, parent_text]
+                for str_match in self.str_matches]
+
 #############################
 # Database connection/setup #
 #############################
 
 # open connection to database
 # then return engine object
-def connect(username, password, database):
-    db_uri = 'mysql+oursql://{}:{}@{}'.format(username, password, database)
+# database is server/database, or a whole url such as sqlite:///bench.db
+# (then username and password aren't used)
+# pool_size: connections kept open, each dataset being run uses two
+def connect(username, password, database, pool_size=5):
+    if '://' in database:
+        db_uri = database
+    else:
+        db_uri = 'mysql+oursql://{}:{}@{}'.format(username, password, database)
     # db_uri = 'mysql://{}:{}@{}'.format(username, password, database)
-    engine = s.create_engine(db_uri, encoding='utf-8')
+    connect_args = {}
+    # a session is handed from pipeline stage to pipeline stage,
+    # but only ever used by one thread at a time
+    engine_args = {}
+    if db_uri.startswith('sqlite'):
+        connect_args['check_same_thread'] = False
+    else:
+        engine_args['pool_size'] = pool_size
+    engine = s.create_engine(db_uri, encoding='utf-8', connect_args=connect_args,
+                **engine_args)
     engine.connect()
     return engine
 
@@ -63,38 +108,49 @@ def createSession(eng):
     session = Session()
     return session
 
-# creates a table class for each table used
-def generateTableClasses(eng):
-    ABase = automap_base()
-    ABase.prepare(eng, reflect=True)
+# reflect just the tables used, not the whole database
+# schema_cache: pickle file keeping the reflected tables between runs,
+# made again if it was for another database or set of tables
+def reflectTables(eng, names, schema_cache=None):
+    key = [repr(eng.url), sorted(names)]
+    metadata = loadPickleCache(schema_cache, key)
+    if metadata is not None:
+        print('Using the table definitions cached in',schema_cache)
+        return metadata
+    metadata = s.MetaData()
+    metadata.reflect(eng, only=names)
+    if schema_cache is not None:
+        savePickleCache(schema_cache, key, metadata)
+    return metadata
+
+# the columns of each table used, e.g. Post.text_id
+def generateTableClasses(eng, schema_cache=None):
+    start = time.perf_counter()
+    metadata = reflectTables(eng, ['posts', 'texts'], schema_cache)
     global Post, Text
-    Post = ABase.classes.posts
-    Text = ABase.classes.texts
+    Post = metadata.tables['posts'].c
+    Text = metadata.tables['texts'].c
+    print('Tables ready in {:.2f}s'.format(time.perf_counter()-start))
 
 ###################
 # String matching #
 ###################
 
 # match_string appears as the first phrase/word in text
-def startOfPostMatch(text, match_string):
-    match_str_len = len(match_string)
-    if len(text) >= match_str_len:
-        if text[:match_str_len] == match_string:
-            return match_string
+def startOfPostMatch(view, match_string):
+    if view.text.startswith(match_string):
+        return match_string
     return None
     
 # match_string appears in the first sentence
-def firstSentenceMatch(text, match_string):
-    modtext = text.replace('?','.')
-    modtext = modtext.replace('!','.')
-    first_sentence = modtext.split('.')[0]
-    if match_string in first_sentence:
+def firstSentenceMatch(view, match_string):
+    if match_string in view.first_sentence:
         return match_string
     return None
 
 # match_string appears anywhere in the text
-def anywhereMatch(text, match_string):
-    if match_string in text:
+def anywhereMatch(view, match_string):
+    if match_string in view.text:
         return match_string
     else:
         return None
@@ -144,6 +200,15 @@ strings_dict = {
 # you're kidding
 # you're joking
 
+# all the "C" strings are found in one pass over the text
+anywhere_matcher = AhoCorasick(
+    {s: strings_dict[s] for s in strings_dict if s[0] == 'C'})
+
+# changes whenever strings_dict does,
+# checkpoints are only good for the strings they were made with
+def patternHash():
+    return hashPatterns(strings_dict)
+
 # keep track of indices to the functions used to find their match string
 match_functions={
     'A':    startOfPostMatch,
@@ -162,110 +227,292 @@ def cleanText(text):
     newtext = newtext.replace('"',"'")
     return newtext
 
-# query the db once per batch, then get matches
-def getBatchMatches(post_id, session):
-    pquery = session.query(Post,Text).\
-                filter(Post.dataset_id==dataset_id).\
-                filter(Post.text_id==Text.text_id).\
-                limit(batch_size).offset(post_id)
+# where clause picking the posts of the dataset after last_key,
+# joined to their texts
+# since/until: only posts with since < text_id <= until, for --incremental
+# shard: (i, N), only the discussions with discussion_id % N == i-1, for --shard
+def postFilter(dataset_id, last_key=None, since=None, until=None, shard=None):
+    conditions = [Post.dataset_id==dataset_id,
+                  Text.dataset_id==dataset_id,
+                  Post.text_id==Text.text_id]
+    if shard is not None:
+        conditions.append(Post.discussion_id % shard[1] == shard[0]-1)
+    if since is not None:
+        conditions.append(Post.text_id > since)
+    if until is not None:
+        conditions.append(Post.text_id <= until)
+    if last_key is not None:
+        last_disc_id, last_post_id = last_key
+        conditions.append(
+                    (Post.discussion_id > last_disc_id) |
+                    ((Post.discussion_id == last_disc_id) &
+                        (Post.post_id > last_post_id)))
+    return s.and_(*conditions)
+
+# go through the dataset one chunk at a time, in (discussion_id, post_id) order
+# one plain select of just the columns needed per chunk, seeking past the
+# last key of the chunk before (keyset paging, never an OFFSET), so every
+# chunk costs about the same and no ORM objects are built
+# each chunk is read to the end straight away, so the server isn't left
+# holding an open result set while the pipeline is busy further down
+# (MySQL gives up on those after net_write_timeout)
+# last_key: start after this (discussion_id, post_id), for --resume
+def iterBatches(session, dataset_id, last_key=None, since=None, until=None, shard=None):
+    size = min(chunk_size, batch_size)
+    while True:
+        query = s.select([Post.discussion_id, Post.post_id, Text.text, Post.parent_post_id]).\
+                    where(postFilter(dataset_id, last_key, since, until, shard)).\
+                    order_by(Post.discussion_id, Post.post_id).\
+                    limit(size)
+        # plain tuples, so chunks can be shipped to worker processes
+        rows = [tuple(row) for row in session.execute(query)]
+        if rows:
+            yield rows
+        if len(rows) < size:
+            return
+        last_key = rows[-1][:2]
+
+# newest text_id in the dataset right now
+# texts get their ids in the order they are imported, so an incremental
+# run picks up everything above the previous run's mark
+def highWaterMark(session, dataset_id):
+    query = s.select([func.max(Post.text_id)]).where(Post.dataset_id==dataset_id)
+    return session.execute(query).scalar()
+
+# one post of an --input dump as an iterBatches row
+def fileRow(record):
+    return (int(record['discussion_id']), int(record['post_id']),
+            record['text'], intOrNone(record.get('parent_post_id')))
+
+# iterBatches for an --input dump, posts come in the order they are in the file
+# last_key: skip everything up to and including this post, for --resume
+def iterFileBatches(path, last_key=None):
+    batch = []
+    for record in readRecords(path):
+        row = fileRow(record)
+        if last_key is not None:
+            if row[:2] == last_key:
+                last_key = None
+            continue
+        batch.append(row)
+        if len(batch) == min(chunk_size, batch_size):
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# every text in an --input dump, keyed like fetchParentTexts keys
+# (a first pass over the file, before the matching one)
+def indexPostFile(path, tmp_dir=None):
+    index = TextIndex(tmp_dir)
+    index.build(((row[1], row[0]), row[2])
+        for row in map(fileRow, readRecords(path)))
+    return index
+
+# get matches from one batch of
+# (discussion_id, post_id, text, parent_post_id) rows
+def getBatchMatches(rows):
     matches = []
-    for p,t in pquery.all():
-        m = getMatchesFromText(p.discussion_id, p.post_id, t.text, p.parent_post_id)
-        matches = matches + m
+    for disc_id, post_id, text, parent_id in rows:
+        m = getMatchesFromText(disc_id, post_id, text, parent_id)
+        if m is not None:
+            matches.append(m)
     return matches
 
 # check for each of the strings in the string_dict
-# if exists, create a Match object
+# if any match, return one PostMatches for the post (None otherwise)
 def getMatchesFromText(disc_id, post_id, text, parent_id):
-    newtext = cleanText(text)
+    view = TextView(text, cleanText)
     str_matches = []
+    anywhere = anywhere_matcher.search(view.text)
     for s in strings_dict:
-        if s[0] in match_functions:
-            str_match = match_functions[s[0]](newtext, strings_dict[s])
+        if s[0] == 'C':
+            if s in anywhere:
+                str_matches.append(strings_dict[s])
+        elif s[0] in match_functions:
+            str_match = match_functions[s[0]](view, strings_dict[s])
             if str_match != None:
                 str_matches.append(str_match)
-    matches = []
-    for str_match in str_matches:
-        m = Match(disc_id, post_id, str_match, newtext, parent_id)
-        matches.append(m)
+    if not str_matches:
+        return None
+    return PostMatches(disc_id, post_id, tuple(str_matches), view.text, parent_id)
+
+# one join on exactly the (parent_post_id, discussion_id) pairs given,
+# returns a dict of pair -> cleaned parent text
+def fetchParentTexts(keys, session, dataset_id):
+    texts = {}
+    for chunk in chunks(keys, parent_chunk_size):
+        pquery = s.select([Post.post_id, Post.discussion_id, Text.text]).\
+                    where((Post.dataset_id==dataset_id) &
+                            (Text.dataset_id==dataset_id) &
+                            (Post.text_id==Text.text_id)).\
+                    where(s.tuple_(Post.post_id, Post.discussion_id).in_(chunk))
+        for post_id, disc_id, text in session.execute(pquery):
+            texts[(post_id, disc_id)] = cleanText(text) if text else None
+    return texts
+
+# the same from the --input dump's index of texts
+def fetchIndexedTexts(keys, index):
+    texts = index.fetch(keys)
+    for key in texts:
+        texts[key] = cleanText(texts[key]) if texts[key] else None
+    return texts
+
+# get the parent's text from the parent_id in PostMatches objects
+# parents not already in the cache are fetched in one go
+# fetch: fetchParentTexts or fetchIndexedTexts with its session/index filled in
+# cache: the dataset's LRUCache of parent texts, see runDataset()
+def addParentText(matches, fetch, cache):
+    keys = set([(m.parent_id, m.disc_id) for m in matches if m.parent_id is not None])
+    ptexts = {}
+    to_fetch = []
+    for key in keys:
+        ptext = cache.get(key)
+        if ptext is missing:
+            to_fetch.append(key)
+        else:
+            ptexts[key] = ptext
+    if to_fetch:
+        fetched = fetch(to_fetch)
+        for key in to_fetch:
+            # parents that aren't in the db get cached as None too
+            ptexts[key] = fetched.get(key)
+            cache.put(key, ptexts[key])
+    # link them up with their respective PostMatches
+    for m in matches:
+        if ptexts.get((m.parent_id, m.disc_id)) is not None:
+            m.parent_text = ptexts[(m.parent_id, m.disc_id)]
     return matches
 
-# TODO 9/10/2015: change query to get parent text, is currently broken
-# get the parent's text from the parent_id in match objects
-def addParentText(matches, session):
-    parent_id_disc_id = {}
-    for m in matches:
-        if m.parent_id is not None:
-            parent_id_disc_id[m.parent_id] = m.disc_id
-    pquery = session.query(Post).\
-                filter(Post.dataset_id==dataset_id).\
-                filter(
-                    Post.post_id.in_(list(parent_id_disc_id)) and 
-                    parent_id_disc_id[Post.post_id]==Post.discussion_id)
-    print(len(pquery.all()))
-    # dict: parent's post_id to its text
-    # post_id_text = []
-    # for p,t in pquery.all():
-    #     print(p.post_)
-    #     text = cleanText(t.text)
-    #     post_id_text[p.post_id] = text
-    # for m in matches:
-    #     if m.parent_id is not None and m.parent_id in post_id_text:
-    #         m.parent_text = post_id_text[m.parent_id]
-    # return matches
-
-# given list of match objects, writes to csv
-def writeMatchesToCSV(matches, csvfile):
-    with open(csvfile,'a', encoding='utf-8') as f:
-        for m in matches:
-            f.write('"'+str(m.disc_id)+'",')
-            f.write('"'+str(m.post_id)+'",')
-            f.write('"'+m.str_match+'",')
-            f.write('"'+m.text+'",')
-            f.write('"'+str(m.parent_id)+'"')
-            # f.write('"'+str(m.parent_text)+'"')
-            f.write('\n')
-    
+
+###################
+# Pipeline stages #
+###################
+
+# each stage takes an iterator of chunks of rows and yields them on to the next
+
+# (rows, matches, None) for each batch, matched here or in a process pool
+# (no --counts here)
+def matchBatches(batches, pool=None, workers=1):
+    if pool is None:
+        for rows in batches:
+            yield rows, getBatchMatches(rows), None
+    else:
+        for rows, matches in orderedPoolMap(pool, getBatchMatches, batches, 2*workers):
+            yield rows, matches, None
+
+# what file a dataset's matches go to
+def outputFile(dataset_id):
+    return "matches_dataset_"+str(dataset_id)+".csv"
+
+header = ['discussion_id','post_id','string matched','post text','parent_post_id','parent text']
+
+# what the shared runDataset() and mergeShards() in matchUtils need from us
+def matchTool():
+    return MatchTool('stringMatchTool', 'post',
+        output_file=outputFile,
+        header=lambda settings: header,
+        key=lambda row: row[:2],
+        csv_key=lambda row: (int(row[0]), int(row[1])),
+        settings=lambda: {'pattern_hash': patternHash()},
+        create_session=createSession,
+        fetch=iterBatches,
+        fetch_file=iterFileBatches,
+        index_file=indexPostFile,
+        high_water_mark=highWaterMark,
+        fetch_parents=fetchParentTexts,
+        fetch_indexed=fetchIndexedTexts,
+        match=matchBatches,
+        add_parents=addParentText)
 
 ##################
 # Main Execution #
 ##################
 
-def main(user=sys.argv[1],pword=sys.argv[2],db=sys.argv[3],dataset=sys.argv[4]):
-
-    # usual stuff to sync with MySQL db, setup
-    print('Connecting to database',db,'as user',user)
-    sys.stdout.flush()
-    eng = connect(user, pword, db)
-    metadata = s.MetaData(bind=eng)
-    session = createSession(eng)
-    generateTableClasses(eng)
-    global dataset_id
-    dataset_id = int(dataset)
-    matches = []
-    # what file to write to
-    csvfile = "matches_dataset_"+dataset+".csv"
-    with open(csvfile,'w',encoding='utf-8') as f:
-        f.write('"discussion_id","post_id","string matched","post text","parent_post_id"\n')
-
-    # query db for # of posts
-    totalPosts = None
-    for ct in session.query(
-            func.count(Post.post_id)).\
-            filter(Post.dataset_id.like(dataset_id)):
-        totalPosts = ct[0]
-        print('total number of posts in dataset:',totalPosts)
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Find string matches in every post of a dataset.')
+    parser.add_argument('user', nargs='?')
+    parser.add_argument('pword', nargs='?')
+    parser.add_argument('db', nargs='?',
+        help='server/database, or a url like sqlite:///bench.db')
+    parser.add_argument('dataset', type=datasetIds,
+        help='dataset id, or several as a list/range like 1-5,9')
+    parser.add_argument('--input', metavar='FILE',
+        help='read posts from a JSONL or CSV dump (.gz/.bz2/.xz too) '
+            'instead of the database; only the dataset argument is needed')
+    parser.add_argument('--compress', choices=sorted(compressors),
+        help='write the csv compressed with gzip, bzip2 or xz')
+    parser.add_argument('--resume', action='store_true',
+        help='carry on from the checkpoint an interrupted run left behind')
+    parser.add_argument('--incremental', action='store_true',
+        help='only match posts added since the last --incremental run, '
+            'appending to its output (everything is rescanned if the patterns changed)')
+    parser.add_argument('--shard', type=shardSpec, metavar='I/N',
+        help='only match the discussions in shard I of N (1 to N), into a file '
+            'of its own; run every shard, then put them together with --merge N')
+    parser.add_argument('--merge', type=int, metavar='N',
+        help='merge the outputs of a finished --shard I/N run, '
+            'no database is needed')
+    parser.add_argument('--batch-size', type=int, default=batch_size,
+        help='posts to go through between checkpoints (default %(default)s), '
+            'memory use doesn\'t depend on it')
+    parser.add_argument('--workers', type=int, default=1,
+        help='match batches in this many processes (default 1)')
+    parser.add_argument('--parallel', type=int, default=1,
+        help='run this many of the datasets at once (default 1), '
+            'sharing the connection pool and worker processes')
+    parser.add_argument('--parent-cache', type=int, default=parent_cache_size,
+        help='parent texts kept between batches (default %(default)s)')
+    parser.add_argument('--schema-cache', metavar='FILE',
+        help='keep the reflected table definitions in FILE, so later runs '
+            'don\'t have to ask the database for them')
+    parser.add_argument('--stats', metavar='FILE',
+        help='write run time, stage timings and peak memory to FILE as json')
+    args = parser.parse_args(argv)
+    if args.input is None and args.db is None and args.merge is None:
+        parser.error('user, pword and db are needed unless reading an --input file')
+    if args.shard is not None and (args.input is not None or args.incremental):
+        parser.error('--shard needs the database and can\'t be used with --incremental')
+    if args.shard is not None and args.merge is not None:
+        parser.error('--merge puts the shards together after they have all been run')
+    if args.input is not None and args.incremental:
+        parser.error('--incremental needs the database, it can\'t be used with --input')
+    if args.input is not None and len(args.dataset) > 1:
+        parser.error('an --input file holds one dataset')
+    return args
+
+def main(args=None):
+    if args is None:
+        args = parseArgs()
+    started = time.perf_counter()
+    user, pword, db = args.user, args.pword, args.db
+    if args.merge is not None:
+        for dataset_id in args.dataset:
+            mergeShards(dataset_id, matchTool(), args)
+        return
+    global batch_size
+    batch_size = args.batch_size
+
+    # one engine, one set of tables and one worker pool for every dataset
+    eng = None
+    if args.input is None:
+        # usual stuff to sync with MySQL db, setup
+        print('Connecting to database',db,'as user',user)
         sys.stdout.flush()
-
-    for post_id in range(totalPosts):
-        if post_id%batch_size == 0:
-            matches = getBatchMatches(post_id, session)
-            # matches = addParentText(matches, session)
-            print('Writing matches from post',post_id,'to',post_id+batch_size-1)
-            sys.stdout.flush()
-            writeMatchesToCSV(matches, csvfile)
-
-    session.close()
+        eng = connect(user, pword, db, pool_size=max(5, 2*args.parallel))
+        generateTableClasses(eng, args.schema_cache)
+
+    # matching can run in a process pool, batches still come out in order
+    # (strings_dict and its automaton are built when each worker imports us)
+    pool = None
+    if args.workers > 1:
+        pool = ProcessPoolExecutor(args.workers, mp_context=workerContext())
+    runDatasets(matchTool(), args, eng, pool, started)
+    if pool is not None:
+        pool.shutdown()
+    if len(args.dataset) > 1:
+        print('Ran',len(args.dataset),'datasets in {:.2f}s'.format(time.perf_counter()-started))
 
 if __name__ == "__main__":
     main()
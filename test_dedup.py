@@ -0,0 +1,113 @@
+# test_dedup.py
+# NLDS lab
+# Checks on matchUtils.TextDeduper and dropSuperseded that need no database
+#
+# e.g.  python -m unittest test_dedup
+
+import csv
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+from matchUtils import TextDeduper, MatchWriter, dropSuperseded
+
+# (text, has_parent) pairs with plenty of repeats, some of them
+# turning up first without a parent and later with one
+def checks(count, distinct, seed=1):
+    rng = random.Random(seed)
+    return [('text '+str(rng.randrange(distinct)), rng.random() < 0.5)
+            for i in range(count)]
+
+class TextDeduperTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='test_dedup_')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def decisions(self, deduper, pairs):
+        return [deduper.check(text, has_parent) for text, has_parent in pairs]
+
+    # spilling to run files (and merging them once there are too many)
+    # must not change which copies are kept
+    def testSpillKeepsTheSameCopies(self):
+        pairs = checks(60000, 45000)
+        in_memory = TextDeduper()
+        spilling = TextDeduper(max_memory=1, spill_dir=self.dir)
+        self.assertEqual(self.decisions(in_memory, pairs), self.decisions(spilling, pairs))
+        self.assertEqual(in_memory.superseded, spilling.superseded)
+        self.assertGreater(spilling.spilled, 0)
+        # enough runs to have been merged at least once
+        self.assertGreater(spilling.run_count, TextDeduper.max_runs+1)
+        self.assertLessEqual(len(spilling.runs), TextDeduper.max_runs+1)
+        self.assertEqual(in_memory.stats()['kept'], spilling.stats()['kept'])
+        in_memory.close()
+        spilling.close()
+        self.assertEqual(os.listdir(self.dir), [])
+
+    # a deduper rebuilt from the journal a checkpoint points at carries on
+    # as if the run had never stopped, whatever was written after it
+    def testJournalReplay(self):
+        pairs = checks(20000, 12000)
+        journal = os.path.join(self.dir, 'journal')
+        whole = TextDeduper()
+        expected = self.decisions(whole, pairs)
+
+        first = TextDeduper(journal=journal)
+        self.decisions(first, pairs[:8000])
+        journal_bytes = first.commitJournal()
+        # written after the checkpoint, then the run dies
+        self.decisions(first, pairs[8000:12000])
+        first.commitJournal()
+        first.close()
+
+        resumed = TextDeduper(max_memory=1, spill_dir=self.dir,
+                    journal=journal, journal_bytes=journal_bytes)
+        self.assertEqual(self.decisions(resumed, pairs[8000:]), expected[8000:])
+        self.assertEqual(resumed.superseded, whole.superseded)
+        resumed.close()
+
+    def testShortJournalIsRefused(self):
+        journal = os.path.join(self.dir, 'journal')
+        deduper = TextDeduper(journal=journal)
+        self.decisions(deduper, checks(100, 50))
+        journal_bytes = deduper.commitJournal()
+        deduper.close()
+        with self.assertRaises(ValueError):
+            TextDeduper(journal=journal, journal_bytes=journal_bytes+TextDeduper.record_size)
+
+    # the first copy of a text is kept, a later one only if it has a parent
+    # and the kept one doesn't; the parentless one is then dropped from the csv
+    def testPreferParent(self):
+        deduper = TextDeduper()
+        posts = [
+            (1, 'same old text', None),
+            (2, 'same old text', 1),
+            (3, 'same old text', 1),
+            (4, 'replied to', 2),
+            (5, 'replied to', None),
+            (6, 'only once', None),
+        ]
+        kept = [post for post in posts if deduper.check(post[1], post[2] is not None)]
+        self.assertEqual([post[0] for post in kept], [1, 2, 4, 6])
+        self.assertEqual(len(deduper.superseded), 1)
+
+        path = os.path.join(self.dir, 'matches.csv')
+        header = ['discussion_id','post_id','string matched','post text','parent_post_id','parent text']
+        writer = MatchWriter(path, header)
+        # two rows for the post that gets superseded, it goes as a whole
+        writer.writeRows([[1, post_id, match, text, str(parent_id), 'None']
+                            for post_id, text, parent_id in kept for match in ('A', 'B')])
+        writer.close()
+        self.assertEqual(dropSuperseded(path, deduper.superseded, 3, 4), 2)
+        with open(path) as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0], header)
+        self.assertEqual([row[1] for row in rows[1:]], ['2', '2', '4', '4', '6', '6'])
+        deduper.close()
+
+if __name__ == "__main__":
+    unittest.main()
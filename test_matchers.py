@@ -0,0 +1,143 @@
+# test_matchers.py
+# NLDS lab
+# Checks that the literal prefilter (requiredLiteral + AhoCorasick in
+# matchUtils.MultiPatternMatcher) finds exactly what plain re.findall does,
+# over regexMatchTool.py's real patterns and some made to trip it up
+#
+# e.g.  python -m unittest test_matchers
+
+import contextlib
+import io
+import random
+import re
+import unittest
+
+import benchmark
+from matchUtils import MultiPatternMatcher, TextView, requiredLiteral
+
+# the tool needs sqlalchemy to import
+try:
+    import regexMatchTool
+except ImportError:
+    regexMatchTool = None
+
+# what MultiPatternMatcher.match() and count() should give, the slow way
+def findallFirst(patterns, text):
+    found = {}
+    for key in patterns:
+        matches = re.findall(patterns[key], text)
+        if matches:
+            found[key] = matches[0]
+    return found
+
+def findallCount(patterns, text):
+    counts = {}
+    for key in patterns:
+        n = len(re.findall(patterns[key], text))
+        if n:
+            counts[key] = n
+    return counts
+
+# patterns the literal search could get wrong, written the way
+# addRegexFromFile() turns lexicon phrases into "C" regexes and otherwise
+adversarial_patterns = {
+    'C you know':           r'\W(you know)\W',
+    'C kind of':            r'\W(kind of)\W',
+    'C i mean*':            r'\W(i mean.*)\W',
+    'C alternation':        r'(foo|bar)baz',
+    'C optional':           r'(colou?r)',
+    'C ignorecase':         r'(?i)(hello)',
+    'C inline ignorecase':  r'a(?i:bc)d',
+    'C class':              r'[abc]at',
+    'C zero or more':       r'x*yz',
+    'C lazy':               r'(q+?rs)',
+    'C lookahead':          r'(?=ab)abc',
+    'C backreference':      r'(ab)\1',
+    'C escapes':            r'\.\*\(',
+    'C two groups':         r'(\w+) (guess)',
+    'C nested groups':      r'((a)(b))c',
+    'C accented':           r'(café)',
+    'C empty':              r'',
+}
+
+adversarial_texts = [
+    '',
+    'i guess',
+    ' i guess ',
+    'i guessi guess i guess.',
+    "you're kidding!!! you're joking? fantastic",
+    'fantastically fantastic, unfantastic',
+    'um... umm.... ummmm',
+    r'\W( ) .* [a-z] (?:x) $^ .*(',
+    'café naïve — i guess — CAFÉ',
+    '\ti\tguess\nyou know\nkind of\n',
+    'you knowyou know you know',
+    'i mean it. i meant it. i mean',
+    'foobaz barbaz bazfoo colour color colr',
+    'HeLLo hello aBcd abCd ABCD',
+    'bat cat rat xxyz yz qqrs qrs abc abab ab',
+    'a'*5000+' fantastic',
+]
+
+@unittest.skipIf(regexMatchTool is None, 'regexMatchTool needs sqlalchemy')
+class MultiPatternMatcherTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with contextlib.redirect_stdout(io.StringIO()):
+            regexMatchTool.loadPatterns(benchmark.lexicon_dir)
+        cls.registry = regexMatchTool.registry
+        cls.anywhere = {key: pattern for key, pattern in regexMatchTool.regex_dict.items()
+                        if key[0] == 'C'}
+        # synthetic posts like benchmark.py's, plus each pattern's literal
+        # in places where the regex around it does and doesn't match
+        rng = random.Random(3)
+        vocabulary = benchmark.loadVocabulary(rng)
+        texts = [benchmark.makeText(rng, vocabulary, benchmark.textLength(rng))
+                    for i in range(300)]
+        for pattern in list(cls.anywhere.values())+list(adversarial_patterns.values()):
+            literal = requiredLiteral(pattern)
+            if literal is not None:
+                texts += [literal, ' '+literal+' ', 'x'+literal+'x', literal+literal,
+                    '. '+literal+', '+literal.upper()+'.']
+        cls.texts = [TextView(text, regexMatchTool.cleanText).text
+                        for text in texts+adversarial_texts]
+
+    def assertSameAsFindall(self, matcher, patterns, texts):
+        for text in texts:
+            self.assertEqual(matcher.match(text), findallFirst(patterns, text), repr(text))
+            self.assertEqual(matcher.count(text), findallCount(patterns, text), repr(text))
+
+    def testRealPatterns(self):
+        self.assertTrue(self.anywhere)
+        self.assertEqual(set(self.anywhere), set(self.registry.anywhere.compiled))
+        self.assertSameAsFindall(self.registry.anywhere, self.anywhere, self.texts)
+        # and the texts do hit every one of them
+        hit = set()
+        for text in self.texts:
+            hit.update(self.registry.anywhere.match(text))
+        self.assertEqual(hit, set(self.anywhere))
+
+    def testAdversarialPatterns(self):
+        compiled = {key: re.compile(pattern) for key, pattern in adversarial_patterns.items()}
+        matcher = MultiPatternMatcher(compiled)
+        self.assertSameAsFindall(matcher, adversarial_patterns, self.texts)
+
+    # every match of a pattern contains its literal, or the prefilter
+    # would skip texts the pattern matches
+    def testLiteralIsInEveryMatch(self):
+        patterns = dict(self.anywhere, **adversarial_patterns)
+        for key, pattern in patterns.items():
+            literal = requiredLiteral(pattern)
+            if literal is None:
+                continue
+            for text in self.texts:
+                for m in re.finditer(pattern, text):
+                    self.assertIn(literal, m.group(0), key)
+
+    def testUnsafeLiteralsAreNotUsed(self):
+        for pattern in [r'(?i)hello', r'(foo|bar)', r'x*', r'', r'[abc]']:
+            self.assertIsNone(requiredLiteral(pattern), pattern)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+# test_pipeline.py
+# NLDS lab
+# Checks on matchUtils.Pipeline that need no database
+#
+# e.g.  python -m unittest test_pipeline
+
+import unittest
+
+from matchUtils import Pipeline
+
+class PipelineTest(unittest.TestCase):
+
+    # a stage that fails stops the source soon after, instead of it
+    # reading the rest of the dataset before the error comes back
+    def testFailureStopsSource(self):
+        produced = []
+        closed = []
+
+        def source():
+            try:
+                for i in range(200):
+                    produced.append(i)
+                    yield i
+            finally:
+                closed.append(True)
+
+        def write(items):
+            for item in items:
+                if item == 3:
+                    raise IOError('disk full')
+                yield item
+
+        pipeline = Pipeline(queue_size=2)
+        pipeline.addSource('fetch', source())
+        pipeline.addStage('match', lambda items: (item for item in items))
+        pipeline.addStage('write', write)
+        with self.assertRaises(IOError):
+            pipeline.run()
+        self.assertLess(len(produced), 20)
+        self.assertEqual(closed, [True])
+
+    def testItemsComeOutInOrder(self):
+        written = []
+
+        def write(items):
+            for item in items:
+                written.append(item)
+                yield item
+
+        pipeline = Pipeline()
+        pipeline.addSource('fetch', range(50))
+        pipeline.addStage('double', lambda items: (2*item for item in items))
+        pipeline.addStage('write', write)
+        pipeline.run()
+        self.assertEqual(written, [2*i for i in range(50)])
+        self.assertEqual(pipeline.stats['write']['items'], 50)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+# test_resume.py
+# NLDS lab
+# Kills the tools part way through a run on a small benchmark.py corpus
+# and checks that --resume finishes it with the same output as a run
+# that was never stopped
+#
+# e.g.  python -m unittest test_resume
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import benchmark
+from matchUtils import compressors, sparse
+
+# the tools need sqlalchemy to run
+try:
+    import sqlalchemy
+except ImportError:
+    sqlalchemy = None
+
+# `python -c kill_after N tool.py args...` runs the tool, but the process
+# dies on the spot while writing chunk N+1: that chunk gets as far as the
+# file, past the last checkpoint, and nothing else is flushed or cleaned
+# up, as if it had been killed
+kill_after = '''
+import os, runpy, sys
+import matchUtils
+limit, calls = int(sys.argv.pop(1)), [0]
+writeRows = matchUtils.MatchWriter.writeRows
+def dyingWriteRows(self, rows):
+    writeRows(self, rows)
+    calls[0] += 1
+    if calls[0] > limit:
+        self.text.flush()
+        os._exit(9)
+matchUtils.MatchWriter.writeRows = dyingWriteRows
+sys.argv.pop(0)
+runpy.run_path(sys.argv[0], run_name='__main__')
+'''
+
+# the whole of an output file, uncompressed
+def readOutput(path):
+    ext = path.rsplit('.', 1)[-1]
+    if ext in compressors:
+        with compressors[ext].open(path, 'rb') as f:
+            return f.read()
+    with open(path, 'rb') as f:
+        return f.read()
+
+@unittest.skipIf(sqlalchemy is None, 'the tools need sqlalchemy')
+class ResumeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp(prefix='test_resume_')
+        cls.db = os.path.join(cls.dir, 'corpus.db')
+        benchmark.makeDatabase(cls.db, posts=2000, tweets=2000, thread_size=20,
+            reply_depth=3, dup_rate=0.1, seed=5)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    # a fresh directory to run a tool in, with the lexicons it reads
+    def workdir(self, name):
+        path = os.path.join(self.dir, name)
+        os.makedirs(path)
+        os.symlink(benchmark.lexicon_dir, os.path.join(path, 'LIWC_lexicons'))
+        return path
+
+    def runTool(self, workdir, tool, args, kill=None):
+        cmd = [sys.executable]
+        if kill is not None:
+            cmd += ['-c', kill_after, str(kill)]
+        cmd += [os.path.join(benchmark.here, benchmark.tools[tool]),
+                'test', 'test', 'sqlite:///'+self.db]
+        if tool != 'twitter':
+            cmd.append(str(benchmark.posts_dataset_id))
+        env = dict(os.environ, PYTHONPATH=benchmark.here)
+        return subprocess.run(cmd+args, cwd=workdir, env=env,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    # run once straight through and once killed after `kill` chunks
+    # and resumed, the outputs must be the same byte for byte
+    def checkResume(self, tool, output, args, kill=6):
+        name = self.id().rsplit('.', 1)[-1]
+        whole = self.workdir(name+'-whole')
+        result = self.runTool(whole, tool, args)
+        self.assertEqual(result.returncode, 0, result.stdout.decode())
+
+        killed = self.workdir(name+'-killed')
+        result = self.runTool(killed, tool, args, kill=kill)
+        self.assertEqual(result.returncode, 9, result.stdout.decode())
+        checkpoint = os.path.join(killed, output.rsplit('.csv', 1)[0]+'.csv.checkpoint')
+        self.assertTrue(os.path.exists(checkpoint))
+        # so the resumed run has to cut the file back
+        with open(checkpoint) as f:
+            offset = json.load(f)['offset']
+        self.assertGreater(os.path.getsize(os.path.join(killed, output)), offset)
+        result = self.runTool(killed, tool, args+['--resume'])
+        self.assertEqual(result.returncode, 0, result.stdout.decode())
+        self.assertIn(b'Resuming after', result.stdout)
+        self.assertFalse(os.path.exists(checkpoint))
+
+        self.assertEqual(readOutput(os.path.join(whole, output)),
+                         readOutput(os.path.join(killed, output)))
+        return whole, killed
+
+    def assertSameCounts(self, whole, killed, prefix):
+        for suffix in ('.rows.csv', '.columns.csv', '.categories.csv'):
+            self.assertEqual(readOutput(os.path.join(whole, prefix+suffix)),
+                             readOutput(os.path.join(killed, prefix+suffix)))
+        for suffix in ('.npz', '.categories.npz'):
+            a = sparse.load_npz(os.path.join(whole, prefix+suffix))
+            b = sparse.load_npz(os.path.join(killed, prefix+suffix))
+            self.assertEqual(a.shape, b.shape)
+            self.assertEqual((a != b).nnz, 0)
+
+    def testStringPlain(self):
+        self.checkResume('string', 'matches_dataset_1.csv', ['--batch-size', '100'])
+
+    def testRegexPlain(self):
+        self.checkResume('regex', 'matches_regex_dataset_1.csv', ['--batch-size', '100'])
+
+    def testRegexCompressed(self):
+        self.checkResume('regex', 'matches_regex_dataset_1.csv.gz',
+            ['--batch-size', '100', '--compress', 'gz'])
+
+    @unittest.skipIf(sparse is None, '--counts needs numpy and scipy')
+    def testRegexCounts(self):
+        whole, killed = self.checkResume('regex', 'matches_regex_dataset_1.csv',
+            ['--batch-size', '100', '--counts', 'c'])
+        self.assertSameCounts(whole, killed, 'c')
+
+    def testTwitterCompressed(self):
+        self.checkResume('twitter', 'matches_regex_dataset_7.csv.bz2',
+            ['--batch-size', '100', '--compress', 'bz2', '--context', '2'])
+
+if __name__ == "__main__":
+    unittest.main()
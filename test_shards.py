@@ -0,0 +1,125 @@
+# test_shards.py
+# NLDS lab
+# Runs the --shard parts of a small benchmark.py corpus as separate
+# processes, each in a directory of its own like separate hosts would,
+# puts them together with --merge and checks the result is what one
+# run over the whole dataset writes, --counts matrices included
+#
+# e.g.  python -m unittest test_shards
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import benchmark
+from matchUtils import sparse
+
+# the tools need sqlalchemy to run
+try:
+    import sqlalchemy
+except ImportError:
+    sqlalchemy = None
+
+shards = 3
+
+def readFile(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+@unittest.skipIf(sqlalchemy is None, 'the tools need sqlalchemy')
+class ShardTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp(prefix='test_shards_')
+        cls.db = os.path.join(cls.dir, 'corpus.db')
+        benchmark.makeDatabase(cls.db, posts=3000, tweets=3000, thread_size=20,
+            reply_depth=3, dup_rate=0.1, seed=11)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    # a fresh directory to run a tool in, with the lexicons it reads
+    def workdir(self, name):
+        path = os.path.join(self.dir, self.id().rsplit('.', 1)[-1], name)
+        os.makedirs(path)
+        os.symlink(benchmark.lexicon_dir, os.path.join(path, 'LIWC_lexicons'))
+        return path
+
+    def command(self, tool, args):
+        cmd = [sys.executable, os.path.join(benchmark.here, benchmark.tools[tool]),
+                'test', 'test', 'sqlite:///'+self.db]
+        if tool != 'twitter':
+            cmd.append(str(benchmark.posts_dataset_id))
+        return cmd+args
+
+    def runTool(self, workdir, tool, args):
+        result = subprocess.run(self.command(tool, args), cwd=workdir,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.assertEqual(result.returncode, 0, result.stdout.decode())
+
+    # one run over the whole dataset, and `shards` shard runs at once
+    # merged in a directory of their own; returns both directories
+    def runSharded(self, tool, args):
+        whole = self.workdir('whole')
+        self.runTool(whole, tool, args)
+
+        parts = []
+        for shard in range(1, shards+1):
+            workdir = self.workdir('shard-'+str(shard))
+            shard_args = args+['--shard', '{}/{}'.format(shard, shards)]
+            parts.append((workdir, subprocess.Popen(self.command(tool, shard_args),
+                cwd=workdir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)))
+        merged = self.workdir('merged')
+        for workdir, process in parts:
+            output = process.communicate()[0]
+            self.assertEqual(process.returncode, 0, output.decode())
+            # the shard outputs copied over from each "host"
+            for name in os.listdir(workdir):
+                if name != 'LIWC_lexicons':
+                    shutil.copy(os.path.join(workdir, name), merged)
+        self.runTool(merged, tool, args+['--merge', str(shards)])
+        return whole, merged
+
+    def assertSameFiles(self, whole, merged, names):
+        for name in names:
+            self.assertEqual(readFile(os.path.join(whole, name)),
+                             readFile(os.path.join(merged, name)), name)
+
+    def assertSameCounts(self, whole, merged, prefix):
+        self.assertSameFiles(whole, merged,
+            [prefix+'.rows.csv', prefix+'.columns.csv', prefix+'.categories.csv'])
+        for suffix in ('.npz', '.categories.npz'):
+            a = sparse.load_npz(os.path.join(whole, prefix+suffix))
+            b = sparse.load_npz(os.path.join(merged, prefix+suffix))
+            self.assertEqual(a.shape, b.shape)
+            self.assertEqual((a != b).nnz, 0)
+
+    def testString(self):
+        whole, merged = self.runSharded('string', ['--batch-size', '200'])
+        self.assertSameFiles(whole, merged, ['matches_dataset_1.csv'])
+
+    # duplicate texts are dropped by --merge rather than the shards
+    def testRegex(self):
+        whole, merged = self.runSharded('regex', ['--batch-size', '200'])
+        self.assertSameFiles(whole, merged, ['matches_regex_dataset_1.csv'])
+
+    @unittest.skipIf(sparse is None, '--counts needs numpy and scipy')
+    def testRegexCounts(self):
+        whole, merged = self.runSharded('regex', ['--batch-size', '200', '--counts', 'c'])
+        self.assertSameFiles(whole, merged, ['matches_regex_dataset_1.csv'])
+        self.assertSameCounts(whole, merged, 'c')
+
+    @unittest.skipIf(sparse is None, '--counts needs numpy and scipy')
+    def testTwitterCounts(self):
+        whole, merged = self.runSharded('twitter',
+            ['--batch-size', '200', '--context', '2', '--counts', 'c'])
+        self.assertSameFiles(whole, merged, ['matches_regex_dataset_7.csv'])
+        self.assertSameCounts(whole, merged, 'c')
+
+if __name__ == "__main__":
+    unittest.main()